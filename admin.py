@@ -1,12 +1,124 @@
 import time
 import streamlit as st
 from utils.printer import get_printer_list, get_printer_status, print_file, print_label
-from utils.config import save_system_config
+from utils.config import save_system_config, system_config
+from utils.journal import JobJournal
 from utils.logger import logger
 
 
 test_file = "utils/fixtures/test.txt"
 
+# A worker that has not reported for this long is shown as lost
+WORKER_LOST_AFTER = 30
+# Seconds between refreshes of the printer status and the worker table
+PRINTER_REFRESH_INTERVAL = 5
+WORKER_REFRESH_INTERVAL = 5
+
+
+@st.cache_resource
+def get_journal():
+    # Read-only, the workers are the only writers
+    return JobJournal(system_config.get("journal_path"), readonly=True)
+
+
+@st.cache_resource
+def get_replay_journal():
+    # Replaying dead letters is the console's one write, one connection for every session
+    return JobJournal(system_config.get("journal_path"))
+
+
+@st.cache_data(ttl=WORKER_REFRESH_INTERVAL, show_spinner=False)
+def worker_state():
+    # One journal query per interval, whatever the number of open consoles
+    journal = get_journal()
+    return journal.workers(), journal.counts()
+
+
+@st.fragment(run_every=WORKER_REFRESH_INTERVAL)
+def workers_tab():
+    st.subheader("Workers")
+    try:
+        workers, counts = worker_state()
+    except Exception as e:
+        st.info(f"No worker has written the journal yet ({e}). Start one with `python worker.py`.")
+        return
+    now = time.time()
+    rows = [{
+        "worker": w["name"],
+        "pid": w["pid"],
+        "state": w["state"] if now - w["seen_at"] < WORKER_LOST_AFTER or w["state"] == "stopped" else "lost",
+        "labels": w["labels"],
+        "last seen": time.strftime("%H:%M:%S", time.localtime(w["seen_at"])),
+    } for w in workers]
+    if rows:
+        st.dataframe(rows, hide_index=True)
+    else:
+        st.info("No worker is running. Start one with `python worker.py`.")
+    st.markdown(" · ".join(f"**{state}:** {n}" for state, n in sorted(counts.items())))
+
+
+@st.fragment
+def dead_letters_tab():
+    # Not refreshed on a timer, so a selection is not lost while choosing
+    st.subheader("Dead letters")
+    try:
+        dead_letters = get_journal().dead_letters()
+    except Exception as e:
+        st.info(f"No worker has written the journal yet ({e}).")
+        return
+    if not dead_letters:
+        st.info("No label has run out of attempts.")
+        return
+    st.dataframe([{
+        "key": d["key"],
+        "attempts": d["attempts"],
+        "error": d["error"],
+        "failed at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(d["updated_at"])),
+    } for d in dead_letters], hide_index=True)
+    selected = st.multiselect("Labels to replay:", [d["job_key"] for d in dead_letters])
+    if st.button("Replay", disabled=not selected):
+        try:
+            replayed = get_replay_journal().replay(selected)
+            logger.info(f"Requested replay of {replayed} dead letters")
+            st.success(f"{replayed} labels will be printed again by the workers.")
+        except Exception as e:
+            logger.error(f"Error replaying dead letters: {str(e)}")
+            st.error(f"Error replaying dead letters: {str(e)}")
+
+
+@st.fragment(run_every=PRINTER_REFRESH_INTERVAL)
+def printer_status(selected_option):
+    # From the printer registry's snapshot in memory, not from CUPS
+    status = get_printer_status(selected_option)
+    status_color = {
+        "Idle": "green",
+        "Active": "blue",
+        "Offline": "red",
+        "Error": "red",
+        "Unknown": "gray"
+    }.get(status, "red")
+
+    st.markdown(f"**Printer Status:** <span style='color: {status_color}'>{status.upper()}</span>", unsafe_allow_html=True)
+
+    # Add test print section
+    # st.subheader("Test Print")
+    # test_text = st.text_area("Enter text to print:", height=100)
+
+    ifdisable = (status !='Idle')
+    if st.button("打印测试", type="secondary", disabled=ifdisable):
+        logger.info(f"Starting test print on printer: {selected_option}")
+        with st.spinner("Printing..."):
+            success, error = print_label(test_file, selected_option)
+            time.sleep(2)
+            # if success
+            if success:
+                logger.info(f"Test print completed successfully on printer: {selected_option}")
+                st.success("Test print completed successfully!")
+            else:
+                logger.error(f"Test print failed on printer: {selected_option} wih error {error}")
+                st.error(f"Test print failed with error {error} . Please check the printer status.")
+
+
 def system_config_tab():
     # st.header("System")
     options = get_printer_list()
@@ -14,50 +126,13 @@ def system_config_tab():
     # Create a dropdown menu using selectbox
     selected_option = st.selectbox('Choose a printer:', options)
     
-    # Clear status cache when printer selection changes
-    if 'last_selected_printer' not in st.session_state:
-        st.session_state.last_selected_printer = None
-    
-    if selected_option != st.session_state.last_selected_printer:
+    if selected_option != st.session_state.get('last_selected_printer'):
         logger.info(f"Printer selection changed to: {selected_option}")
         st.session_state.last_selected_printer = selected_option
-        st.session_state.printer_status = None  # Clear status cache
-    
-    # Display printer status
+
+    # Display printer status, refreshed on its own without rerunning the page
     if selected_option:
-        # Get fresh status if cache is cleared
-        if st.session_state.printer_status is None:
-            st.session_state.printer_status = get_printer_status(selected_option)
-            logger.info(f"Printer {selected_option} status: {st.session_state.printer_status}")
-        
-        status = st.session_state.printer_status
-        status_color = {
-            "Idle": "green",
-            "Active": "blue",
-            "Offline": "red",
-            "Error": "red",
-            "Unknown": "gray"
-        }.get(status, "red")
-        
-        st.markdown(f"**Printer Status:** <span style='color: {status_color}'>{status.upper()}</span>", unsafe_allow_html=True)
-        
-        # Add test print section
-        # st.subheader("Test Print")
-        # test_text = st.text_area("Enter text to print:", height=100)
-        
-        ifdisable = (status !='Idle')
-        if st.button("打印测试", type="secondary", disabled=ifdisable):
-            logger.info(f"Starting test print on printer: {selected_option}")
-            with st.spinner("Printing..."):
-                success, error = print_label(test_file, selected_option)
-                time.sleep(2)
-                # if success
-                if success:
-                    logger.info(f"Test print completed successfully on printer: {selected_option}")
-                    st.success("Test print completed successfully!")
-                else:
-                    logger.error(f"Test print failed on printer: {selected_option} wih error {error}")
-                    st.error(f"Test print failed with error {error} . Please check the printer status.")
+        printer_status(selected_option)
     
     st.markdown("---")
     # Add button to save selected printer
@@ -77,4 +152,8 @@ def system_config_tab():
 
 st.title("🛠️ Admin Panel")
 
-system_config_tab()
\ No newline at end of file
+system_config_tab()
+st.markdown("---")
+workers_tab()
+st.markdown("---")
+dead_letters_tab()
@@ -1,72 +1,18 @@
 import streamlit as st
-import boto3
-from botocore.exceptions import NoCredentialsError
-import time, json
-import threading
-from utils.printer import print_label
-from utils.logger import logger
-from utils.config import get_default_printer
+from utils.logger import CONSOLE_LOG, setup_logger
 
-pg = st.navigation([st.Page("admin.py"), st.Page("log.py")])
-
-q_url = 'https://sqs.eu-north-1.amazonaws.com/613860947073/testq'
-region_name = 'eu-north-1'
-
-def s3():
-    return boto3.client('s3')
-
-def sqs():
-    return boto3.client('sqs', region_name=region_name)
+# Once per process, later reruns find the logger already set up
+setup_logger('admin', CONSOLE_LOG)
 
-def handle_new_file(bucket, key):
-    logger.info(f"New file detected: {key}")
-    # load printer name
-    printer = get_default_printer()
-    logger.debug(f"get default printer {printer}")
-    # Download file
-    local_filename = key.split('/')[-1]
-    try:
-        s3().download_file(bucket, key, local_filename)
-        logger.info(f"Downloaded {local_filename}")
-    except Exception as e:
-        logger.error(f"Download failed: {e}")
-    # Print file
-    logger.info(f"start print file {local_filename}")
-    success, error = print_label(local_filename, printer)
-    if success:
-        logger.info(f"Print {local_filename} successfully!")
-    else:
-        logger.error(f"Print {local_filename} failed with error {error}")
 
+@st.cache_resource
+def load_image(path):
+    # Read once per process instead of on every rerun of the page
+    with open(path, 'rb') as f:
+        return f.read()
 
-def poll_sqs():
-    logger.info("Polling SQS for messages...")
-    while True:
-        response = sqs().receive_message(
-            QueueUrl=q_url,
-            MaxNumberOfMessages=5,
-            WaitTimeSeconds=10
-        )
-        messages = response.get('Messages', [])
-
-        for message in messages:
-            body = json.loads(message['Body'])
-            # If it's an S3 event, handle it
-            if 'Records' in body:
-                for record in body['Records']:
-                    if record['eventSource'] == 'aws:s3':
-                        bucket = record['s3']['bucket']['name']
-                        key = record['s3']['object']['key']
-                        handle_new_file(bucket, key)
-
-            # Delete the message from the queue
-            sqs().delete_message(
-                QueueUrl=q_url,
-                ReceiptHandle=message['ReceiptHandle']
-            )
-
-        time.sleep(1)
 
+pg = st.navigation([st.Page("admin.py"), st.Page("log.py")])
 
 # Add sidebar elements
 with st.sidebar:
@@ -102,14 +48,10 @@ with st.sidebar:
             }
             </style>
         """, unsafe_allow_html=True)
-        st.image(image_path, use_container_width=True)
+        st.image(load_image(image_path), use_container_width=True)
 
 
+# Labels are printed by the worker processes (python worker.py), the app only shows their state
 pg.run()
-if 'sqs_thread_started' not in st.session_state:
-    st.session_state.sqs_thread_started = True
-    thread = threading.Thread(target=poll_sqs, daemon=True)
-    thread.start()
-    print("Started background SQS poller")
 
 
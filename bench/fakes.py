@@ -0,0 +1,286 @@
+"""
+In-process stand-ins for SQS, S3 and the cups module, for benchmarking the
+pipeline without AWS or a printer.
+"""
+import io
+import itertools
+import json
+import random
+import threading
+import time
+import types
+import uuid
+
+# IPP job-state values
+JOB_PENDING = 3
+JOB_PROCESSING = 5
+JOB_CANCELED = 7
+JOB_ABORTED = 8
+JOB_COMPLETED = 9
+
+
+class FakeSQS:
+    """A single in-memory queue with long polling and visibility timeouts."""
+
+    def __init__(self, visibility_timeout=30):
+        self.visibility_timeout = visibility_timeout
+        self.messages = {}
+        self.sent_at = {}
+        self.deleted_at = {}
+        self.receive_calls = 0
+        self.empty_receives = 0
+        self.cond = threading.Condition()
+
+    def send(self, body):
+        message_id = str(uuid.uuid4())
+        with self.cond:
+            self.messages[message_id] = {'body': json.dumps(body), 'visible_at': 0, 'receipt': None, 'receives': 0}
+            self.sent_at[message_id] = time.monotonic()
+            self.cond.notify_all()
+        return message_id
+
+    def send_s3_event(self, bucket, key, size=None):
+        obj = {'key': key}
+        if size is not None:
+            obj['size'] = size
+        record = {
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {'bucket': {'name': bucket}, 'object': obj},
+        }
+        return self.send({'Records': [record]})
+
+    def _visible(self, now):
+        return [(message_id, m) for message_id, m in self.messages.items() if m['visible_at'] <= now]
+
+    def receive_message(self, QueueUrl=None, MaxNumberOfMessages=1, WaitTimeSeconds=0,
+                        VisibilityTimeout=None, **kwargs):
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self.cond:
+            self.receive_calls += 1
+            while True:
+                now = time.monotonic()
+                visible = self._visible(now)
+                if visible or now >= deadline:
+                    break
+                self.cond.wait(min(deadline - now, 0.05))
+            out = []
+            for message_id, m in visible[:MaxNumberOfMessages]:
+                m['receipt'] = f"{message_id}:{uuid.uuid4()}"
+                m['visible_at'] = now + (VisibilityTimeout or self.visibility_timeout)
+                m['receives'] += 1
+                out.append({'MessageId': message_id, 'ReceiptHandle': m['receipt'], 'Body': m['body'],
+                            'Attributes': {'ApproximateReceiveCount': str(m['receives'])}})
+            if not out:
+                self.empty_receives += 1
+        return {'Messages': out} if out else {}
+
+    def _find(self, receipt):
+        message_id = receipt.split(':', 1)[0]
+        m = self.messages.get(message_id)
+        if m is None or m['receipt'] != receipt:
+            return None, None
+        return message_id, m
+
+    def delete_message_batch(self, QueueUrl=None, Entries=()):
+        successful, failed = [], []
+        with self.cond:
+            for entry in Entries:
+                message_id, m = self._find(entry['ReceiptHandle'])
+                if m is None:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'Message': 'stale'})
+                    continue
+                del self.messages[message_id]
+                self.deleted_at[message_id] = time.monotonic()
+                successful.append({'Id': entry['Id']})
+        return {'Successful': successful, 'Failed': failed}
+
+    def delete_message(self, QueueUrl=None, ReceiptHandle=None):
+        self.delete_message_batch(QueueUrl, [{'Id': '0', 'ReceiptHandle': ReceiptHandle}])
+
+    def change_message_visibility_batch(self, QueueUrl=None, Entries=()):
+        successful, failed = [], []
+        with self.cond:
+            now = time.monotonic()
+            for entry in Entries:
+                _, m = self._find(entry['ReceiptHandle'])
+                if m is None:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'Message': 'stale'})
+                    continue
+                m['visible_at'] = now + entry['VisibilityTimeout']
+                successful.append({'Id': entry['Id']})
+            self.cond.notify_all()
+        return {'Successful': successful, 'Failed': failed}
+
+    def latencies(self):
+        """Seconds from send to delete of every deleted message."""
+        return [self.deleted_at[m] - self.sent_at[m] for m in self.deleted_at]
+
+
+class FakeS3:
+    """Object store keyed by (bucket, key) with a fixed per-request latency."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+
+    def put(self, bucket, key, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.objects[(bucket, key)] = data
+
+    def get_object(self, Bucket, Key, **kwargs):
+        time.sleep(self.latency)
+        data = self.objects[(Bucket, Key)]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(data), 'ETag': f'"{hash(data) & 0xffffffff:08x}"', 'Metadata': {}}
+
+
+class _Printer:
+    def __init__(self, latency, fault_rate):
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.busy_until = 0
+        self.state = 3
+        self.reasons = ['none']
+
+
+class _Job:
+    def __init__(self, printer):
+        self.printer = printer
+        self.documents = 0
+        self.start = None
+        self.end = None
+        self.fails = False
+        self.canceled = False
+
+
+class FakeCups:
+    """
+    Simulated CUPS server. Each printer prints one job at a time taking
+    latency seconds per document, and aborts a fraction fault_rate of jobs.
+    """
+
+    def __init__(self, printers, latency=0.5, fault_rate=0.0):
+        self.printers = {name: _Printer(latency, fault_rate) for name in printers}
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def set_printer(self, name, state=None, reasons=None, latency=None):
+        with self.lock:
+            printer = self.printers[name]
+            if state is not None:
+                printer.state = state
+            if reasons is not None:
+                printer.reasons = reasons
+            if latency is not None:
+                printer.latency = latency
+
+    def _schedule(self, job):
+        printer = self.printers[job.printer]
+        start = max(time.monotonic(), printer.busy_until)
+        job.start = start
+        job.end = start + printer.latency * max(job.documents, 1)
+        job.fails = random.random() < printer.fault_rate
+        printer.busy_until = job.end
+
+    def _job_state(self, job, now):
+        if job.canceled:
+            return JOB_CANCELED
+        if job.start is None or now < job.start:
+            return JOB_PENDING
+        if self.printers[job.printer].state == 5:
+            # A stopped printer holds its jobs
+            return JOB_PENDING
+        if now < job.end:
+            return JOB_PROCESSING
+        return JOB_ABORTED if job.fails else JOB_COMPLETED
+
+    def module(self):
+        """A module object that can replace cups in sys.modules."""
+        fake = self
+        module = types.ModuleType('cups')
+
+        class IPPError(Exception):
+            pass
+
+        class Connection:
+            def getPrinters(self):
+                now = time.monotonic()
+                with fake.lock:
+                    return {name: {'printer-state': p.state, 'printer-state-reasons': list(p.reasons),
+                                   'printer-busy': p.busy_until > now}
+                            for name, p in fake.printers.items()}
+
+            def getJobs(self, which_jobs='not-completed', my_jobs=False, limit=-1, first_job_id=-1,
+                        requested_attributes=None):
+                now = time.monotonic()
+                out = {}
+                with fake.lock:
+                    for job_id, job in fake.jobs.items():
+                        if job_id < first_job_id:
+                            continue
+                        state = fake._job_state(job, now)
+                        if which_jobs == 'not-completed' and state >= JOB_CANCELED:
+                            continue
+                        out[job_id] = {'job-id': job_id, 'job-state': state,
+                                       'job-printer-uri': f"ipp://localhost/printers/{job.printer}"}
+                return out
+
+            def getJobAttributes(self, job_id, requested_attributes=None):
+                with fake.lock:
+                    if job_id not in fake.jobs:
+                        raise IPPError(0x0406, f"Job #{job_id} does not exist")
+                    return {'job-state': fake._job_state(fake.jobs[job_id], time.monotonic())}
+
+            def createJob(self, printer, title, options):
+                with fake.lock:
+                    if printer not in fake.printers:
+                        raise IPPError(1030, f"The printer or class does not exist: {printer}")
+                    job_id = next(fake.ids)
+                    fake.jobs[job_id] = _Job(printer)
+                    return job_id
+
+            def startDocument(self, printer, job_id, name, document_format, last_document):
+                with fake.lock:
+                    job = fake.jobs[job_id]
+                    job.documents += 1
+                    if last_document:
+                        fake._schedule(job)
+
+            def writeRequestData(self, data, length):
+                return 0
+
+            def finishDocument(self, printer):
+                return module.IPP_OK
+
+            def printFile(self, printer, filename, title, options):
+                job_id = self.createJob(printer, title, options)
+                self.startDocument(printer, job_id, filename, module.CUPS_FORMAT_TEXT, 1)
+                return job_id
+
+            def cancelJob(self, job_id, purge_job=False):
+                with fake.lock:
+                    fake.jobs[job_id].canceled = True
+
+            def moveJob(self, printer_uri=None, job_id=-1, job_printer_uri=None):
+                with fake.lock:
+                    job = fake.jobs[job_id]
+                    if fake._job_state(job, time.monotonic()) != JOB_PENDING:
+                        raise IPPError(1030, "Job is not pending")
+                    job.printer = job_printer_uri.rsplit('/', 1)[-1]
+                    fake._schedule(job)
+
+            def createSubscription(self, *args, **kwargs):
+                raise IPPError(1280, "Subscriptions are not supported")
+
+        module.IPPError = IPPError
+        module.Connection = Connection
+        module.IPP_OK = 0
+        module.IPP_NOT_FOUND = 0x0406
+        module.CUPS_FORMAT_TEXT = 'text/plain'
+        return module
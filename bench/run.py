@@ -0,0 +1,152 @@
+"""
+End-to-end throughput benchmark of the print pipeline against in-process
+SQS, S3 and CUPS stand-ins.
+
+    python -m bench.run --profile burst
+    python -m bench.run --profile slow_printer --mode sequential
+    python -m bench.run --profile burst --set '{"batch_window_ms": 50}'
+
+Reports labels/sec, p50/p99 latency from SQS send to delete and the peak
+Python memory allocated during the run.
+"""
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+from bench.fakes import FakeCups, FakeS3, FakeSQS
+
+BUCKET = 'bench-bucket'
+
+PROFILES = {
+    # 50 chat labels arriving at once on one printer
+    "burst": dict(labels=50, text_size=300, printers=1, printer_latency=0.2, s3_latency=0.01),
+    # fewer but much longer texts, stresses download and layout
+    "large": dict(labels=20, text_size=200_000, printers=1, printer_latency=0.2, s3_latency=0.05),
+    # a slow printer, throughput should be bound by it alone
+    "slow_printer": dict(labels=20, text_size=300, printers=1, printer_latency=1.0, s3_latency=0.01),
+    # several printers sharing the load
+    "multi_printer": dict(labels=60, text_size=300, printers=3, printer_latency=0.3, s3_latency=0.01),
+    # printers that abort some jobs
+    "faults": dict(labels=40, text_size=300, printers=2, printer_latency=0.2, s3_latency=0.01,
+                   fault_rate=0.1),
+}
+
+SAMPLE_TEXT = "本艺术装置以苹果为象征，探讨自然与人类文明的交汇。Labels mix CJK and ASCII text.\n"
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def install_fakes(profile, overrides):
+    """Put the fakes in place before any pipeline module is imported."""
+    printers = [f"bench-printer-{i}" for i in range(profile["printers"])]
+    cups = FakeCups(printers, latency=profile["printer_latency"], fault_rate=profile.get("fault_rate", 0.0))
+    sys.modules['cups'] = cups.module()
+
+    from utils.config import system_config
+    system_config.override({
+        "printer": printers[0],
+        "printers": printers,
+        "metrics_port": 0,
+        "journal_path": ":memory:",
+        **overrides,
+    })
+    from utils.logger import WORKER_LOG, setup_logger
+    # The pipeline logs as it would in a worker
+    setup_logger('admin', WORKER_LOG)
+
+    from utils import aws, poller
+    sqs, s3 = FakeSQS(), FakeS3(latency=profile["s3_latency"])
+    aws._clients[('sqs', poller.region_name)] = sqs
+    aws._clients[('s3', None)] = s3
+    return sqs, s3, cups
+
+
+def load(sqs, s3, profile):
+    text = (SAMPLE_TEXT * (profile["text_size"] // len(SAMPLE_TEXT) + 1))[:profile["text_size"]]
+    for i in range(profile["labels"]):
+        key = f"labels/bench-{i}.txt"
+        s3.put(BUCKET, key, text)
+        sqs.send_s3_event(BUCKET, key, size=len(text.encode('utf-8')))
+
+
+def run_pipeline(sqs, labels, timeout):
+    from utils.poller import build_pipeline
+    pipeline = build_pipeline()
+    pipeline.start()
+    wait_for(sqs, labels, timeout)
+    pipeline.stop()
+
+
+def run_sequential(sqs, labels, timeout):
+    """The original poll_sqs loop: handle every record inline, then delete."""
+    from utils.pipeline import parse_records
+    from utils.poller import delete_messages, handle_new_file, receive_messages
+    from utils.pipeline import Message
+
+    deadline = time.monotonic() + timeout
+    while len(sqs.deleted_at) < labels and time.monotonic() < deadline:
+        messages = [Message(raw) for raw in receive_messages()]
+        for message in messages:
+            for record in parse_records(message.raw['Body']):
+                handle_new_file(record.bucket, record.key)
+        if messages:
+            delete_messages(messages)
+
+
+def wait_for(sqs, labels, timeout):
+    deadline = time.monotonic() + timeout
+    while len(sqs.deleted_at) < labels and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="burst")
+    parser.add_argument("--mode", choices=["pipeline", "sequential"], default="pipeline")
+    parser.add_argument("--labels", type=int, help="override the number of labels of the profile")
+    parser.add_argument("--set", default="{}", help="JSON object of system config overrides")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    profile = dict(PROFILES[args.profile])
+    if args.labels:
+        profile["labels"] = args.labels
+    sqs, s3, cups = install_fakes(profile, json.loads(args.set))
+    load(sqs, s3, profile)
+
+    tracemalloc.start()
+    start = time.monotonic()
+    runner = run_pipeline if args.mode == "pipeline" else run_sequential
+    thread = threading.Thread(target=runner, args=(sqs, profile["labels"], args.timeout), daemon=True)
+    thread.start()
+    wait_for(sqs, profile["labels"], args.timeout)
+    elapsed = (max(sqs.deleted_at.values()) if sqs.deleted_at else time.monotonic()) - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = sqs.latencies()
+    done = len(latencies)
+    failed = sum(1 for job in cups.jobs.values() if job.fails or job.canceled)
+    print(f"profile        {args.profile} ({args.mode})")
+    print(f"labels         {done}/{profile['labels']} acknowledged, {failed} CUPS jobs failed")
+    print(f"cups jobs      {len(cups.jobs)}")
+    print(f"sqs receives   {sqs.receive_calls} ({sqs.empty_receives} empty)")
+    print(f"throughput     {done / elapsed if elapsed > 0 else float('nan'):.2f} labels/sec")
+    print(f"latency p50    {percentile(latencies, 50):.3f} s")
+    print(f"latency p99    {percentile(latencies, 99):.3f} s")
+    print(f"latency mean   {statistics.fmean(latencies) if latencies else float('nan'):.3f} s")
+    print(f"peak memory    {peak / 1024 / 1024:.1f} MiB")
+    return 0 if done == profile["labels"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
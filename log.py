@@ -1,44 +1,89 @@
 import streamlit as st
-import time
 import re
+from datetime import datetime, timedelta
+from utils.log_reader import LogReader, compile_filter
+from utils.logger import LOG_FILES
 
 # --- Settings ---
-LOG_FILE = 'logs/admin.log'
+LOG_DIR = 'logs'
 TAIL_LINES = 200
 REFRESH_INTERVAL = 2  # seconds
 
-st.title("🔍 Real-time Log Viewer")
 
-# --- UI ---
-filter_text = st.text_input("Filter (regex supported)", "")
-highlight_errors = st.checkbox("Highlight ERROR", value=True)
+@st.cache_resource
+def get_log_reader(log_file):
+    # Shared by every session so the file is only read once per refresh
+    return LogReader(f"{LOG_DIR}/{log_file}", TAIL_LINES)
 
-# --- Read Log File ---
-try:
-    with open(LOG_FILE, 'r') as f:
-        lines = f.readlines()[-TAIL_LINES:]
-except FileNotFoundError:
-    st.warning("Log file not found.")
-    st.stop()
-except Exception as e:
-    st.error(f"Error reading log file: {e}")
-    st.stop()
-
-# --- Filter ---
-if filter_text:
-    try:
-        lines = [line for line in lines if re.search(filter_text, line)]
-    except re.error as err:
-        st.error(f"Invalid regex: {err}")
-        st.stop()
 
 # --- Highlight ---
-def highlight(line):
+def highlight(line, highlight_errors):
     if highlight_errors and ("ERROR" in line or "CRITICAL" in line):
         return f"<span style='color:red; font-weight:bold;'>{line}</span>"
     return f"<span style='color:gray;'>{line}</span>"
 
-formatted = "".join([highlight(line) for line in lines])
+
+def render(lines, highlight_errors):
+    formatted = "".join([highlight(line, highlight_errors) for line in lines])
+    return f"<div style='font-family: monospace; white-space: pre-wrap;'>{formatted}</div>"
+
+
+@st.cache_data(ttl=REFRESH_INTERVAL, show_spinner=False)
+def render_tail(log_file, filter_text, highlight_errors):
+    # Operators watching with the same settings share one rendering per interval
+    lines = get_log_reader(log_file).tail()
+    if filter_text:
+        pattern = compile_filter(filter_text)
+        lines = [line for line in lines if pattern.search(line)]
+    return render(lines, highlight_errors)
+
+
+def show_errors(read):
+    try:
+        return read()
+    except FileNotFoundError:
+        st.warning("Log file not found.")
+    except re.error as err:
+        st.error(f"Invalid regex: {err}")
+    except Exception as e:
+        st.error(f"Error reading log file: {e}")
+    return None
+
+
+# --- Only this panel reruns on the refresh interval, not the whole app ---
+@st.fragment(run_every=REFRESH_INTERVAL)
+def log_tail(log_file, filter_text, highlight_errors):
+    html = show_errors(lambda: render_tail(log_file, filter_text, highlight_errors))
+    if html is not None:
+        st.markdown(html, unsafe_allow_html=True)
+
+
+def log_history(log_file, filter_text, highlight_errors, start, end):
+    lines = show_errors(lambda: get_log_reader(log_file).search(filter_text or None, start, end,
+                                                                limit=TAIL_LINES))
+    if lines is not None:
+        st.markdown(render(lines, highlight_errors), unsafe_allow_html=True)
+
+
+st.title("🔍 Real-time Log Viewer")
+
+# --- UI ---
+# The console and the print workers each write their own log
+log_file = st.selectbox("Log", LOG_FILES)
+filter_text = st.text_input("Filter (regex supported)", "")
+highlight_errors = st.checkbox("Highlight ERROR", value=True)
+with st.expander("Search history"):
+    search_history = st.checkbox("Search a time range, including rotated logs", value=False)
+    # Keep the defaults fixed so reruns do not reset the inputs
+    if 'history_range' not in st.session_state:
+        now = datetime.now().replace(microsecond=0)
+        st.session_state.history_range = (now - timedelta(hours=1), now)
+    default_start, default_end = st.session_state.history_range
+    col1, col2 = st.columns(2)
+    start_date = col1.date_input("From", default_start.date())
+    start_time = col1.time_input("From time", default_start.time(), label_visibility="collapsed")
+    end_date = col2.date_input("To", default_end.date())
+    end_time = col2.time_input("To time", default_end.time(), label_visibility="collapsed")
 
 # --- Inject JS for Auto-Scroll ---
 st.markdown("""
@@ -48,11 +93,9 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Display Log Content ---
-st.markdown(
-    f"<div style='font-family: monospace; white-space: pre-wrap;'>{formatted}</div>",
-    unsafe_allow_html=True
-)
-
-# --- Auto Refresh ---
-time.sleep(REFRESH_INTERVAL)
-st.rerun()
+if search_history:
+    # A time range does not change, it is only searched when the inputs do
+    log_history(log_file, filter_text, highlight_errors,
+                datetime.combine(start_date, start_time), datetime.combine(end_date, end_time))
+else:
+    log_tail(log_file, filter_text, highlight_errors)
@@ -0,0 +1,34 @@
+import threading
+import boto3
+from botocore.config import Config
+from utils.config import system_config
+
+# boto3 clients are thread-safe once created, but creating them is not and is
+# expensive (credential, endpoint and connection pool setup), so every caller
+# shares one client per (service, region).
+_clients = {}
+_lock = threading.Lock()
+
+
+def client_config():
+    return Config(
+        max_pool_connections=system_config.get("aws_max_pool_connections"),
+        retries={
+            "max_attempts": system_config.get("aws_max_attempts"),
+            "mode": "standard",
+        },
+    )
+
+
+def get_client(service, region_name=None):
+    """Get the shared boto3 client for a service, creating it on first use."""
+    key = (service, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                session = boto3.session.Session()
+                client = session.client(service, region_name=region_name, config=client_config())
+                _clients[key] = client
+    return client
@@ -0,0 +1,75 @@
+import threading
+
+from utils.config import system_config
+from utils.job_monitor import JobFuture
+
+
+class _Batch:
+    def __init__(self):
+        self.documents = []
+        self.futures = []
+        self.timer = None
+
+
+class LabelBatcher:
+    """
+    Coalesce labels for the same printer into multi-document CUPS jobs.
+
+    Labels added within batch_window_ms of the first one, up to
+    batch_max_documents, are submitted together through
+    submit(documents, printer_name, title). Every label still gets its own
+    JobFuture, which learns its job_id as soon as the batch is submitted and
+    resolves with the outcome of the job it ended up in. CUPS reports one
+    state per job, so when any document of a batch fails, every label in it
+    fails and is retried.
+    """
+
+    def __init__(self, submit):
+        self.submit = submit
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def enabled():
+        return system_config.get("batch_window_ms") > 0
+
+    def add(self, printer_name, text, title):
+        future = JobFuture(printer_name=printer_name)
+        with self.lock:
+            batch = self.batches.setdefault(printer_name, _Batch())
+            batch.documents.append((title, text))
+            batch.futures.append(future)
+            full = len(batch.documents) >= system_config.get("batch_max_documents")
+            if not full and batch.timer is None:
+                batch.timer = threading.Timer(system_config.get("batch_window_ms") / 1000,
+                                              self.flush, args=(printer_name,))
+                batch.timer.daemon = True
+                batch.timer.start()
+        if full:
+            self.flush(printer_name)
+        return future
+
+    def pending(self, printer_name):
+        """Number of labels waiting for the batch window of printer_name."""
+        with self.lock:
+            batch = self.batches.get(printer_name)
+            return len(batch.documents) if batch else 0
+
+    def flush(self, printer_name):
+        with self.lock:
+            batch = self.batches.pop(printer_name, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        title = batch.documents[0][0] if len(batch.documents) == 1 else f"Batch of {len(batch.documents)} labels"
+        job = self.submit(batch.documents, printer_name, title)
+        if job.job_id is not None:
+            for future in batch.futures:
+                future.set_job_id(job.job_id)
+
+        def done(job):
+            for future in batch.futures:
+                future.set_result(job.result())
+
+        job.add_done_callback(done)
@@ -1,50 +1,232 @@
 import json
 import os
 import logging
+import tempfile
+import threading
+import time
+from types import MappingProxyType
+
+# Seconds between checks of system_config.json for changes by other processes
+CONFIG_POLL_INTERVAL = 0.2
+
+
+DEFAULT_CONFIG = {
+    "printer": "",
+    # printer pool, falls back to "printer" when empty
+    "printers": [],
+    # pipeline concurrency
+    "download_workers": 4,
+    "print_workers": 2,
+    "queue_size": 20,
+    "max_inflight_jobs": 20,
+    # priority classes and their fair-share weights; a label's class comes from
+    # its "priority" object metadata, else the longest matching key prefix
+    "priority_classes": {"interactive": 8, "normal": 4, "bulk": 1},
+    "priority_prefixes": {},
+    "priority_default": "normal",
+    # SQS queues, each {"url", "region", "name", "pollers", "max_inflight", "priority"};
+    # empty polls the queue in utils/poller.py and sqs_priority_queue_url
+    "sqs_queues": [],
+    # optional second SQS queue, all its labels get sqs_priority_class
+    "sqs_priority_queue_url": "",
+    "sqs_priority_class": "interactive",
+    # labels received beyond what the printers can take, for the scheduler to reorder
+    "scheduler_lookahead": 10,
+    # S3 events that are printed, checked before downloading; empty lists allow everything
+    "event_types": ["ObjectCreated:"],
+    "event_prefixes": [],
+    "event_suffixes": [],
+    "max_object_bytes": 50 * 1024 * 1024,
+    # larger text objects are streamed from S3 to CUPS instead of read into memory
+    "stream_threshold_bytes": 1024 * 1024,
+    # polling pauses while every healthy printer has this many jobs queued
+    "printer_queue_depth": 5,
+    # seconds a CUPS job may take once the printer starts on it before it is cancelled
+    "cups_job_timeout": 15,
+    # coalesce labels into multi-document jobs, 0 disables batching
+    "batch_window_ms": 0,
+    "batch_max_documents": 10,
+    # label rendering, "text" for the CUPS text filter or "pdf"
+    "render_mode": "text",
+    "render_dpi": 203,
+    "render_font": "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "render_processes": 2,
+    "render_cache_size": 256,
+    # logging, log_rotate_when (e.g. "midnight") switches from size to time based rotation
+    "log_format": "text",
+    "log_max_bytes": 10 * 1024 * 1024,
+    "log_backup_count": 5,
+    "log_rotate_when": "",
+    "log_compress": False,
+    # prometheus /metrics endpoint, port 0 disables it
+    "metrics_port": 9108,
+    "metrics_addr": "127.0.0.1",
+    # durable job journal
+    "journal_path": "journal.db",
+    "journal_retention_days": 7,
+    # seconds a received message stays invisible, extended while its labels print
+    "sqs_visibility_timeout": 30,
+    # seconds a stopping worker waits for its labels before leaving them to the next start
+    "drain_timeout": 60,
+    # attempts per label before it is dead-lettered, with exponential backoff in between
+    "retry_max_attempts": 5,
+    "retry_base_delay": 2,
+    "retry_max_delay": 300,
+    # shared boto3 clients
+    "aws_max_pool_connections": 20,
+    "aws_max_attempts": 5,
+    # printer registry
+    "printer_refresh_interval": 5,
+    "printer_events": False,
+}
+
+
+def _freeze(value):
+    """Read-only copy of a config value, nested dicts and lists included."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _read_object(f):
+    config_data = json.load(f)
+    if not isinstance(config_data, dict):
+        raise ValueError(f"expected a JSON object, got {type(config_data).__name__}")
+    return config_data
+
+
+def _validate(config):
+    """Replace values that would break the workers, logging each one."""
+    classes = config["priority_classes"]
+    if not isinstance(classes, dict):
+        logging.error(f"priority_classes must be an object of weights, using the default: {classes!r}")
+        config["priority_classes"] = DEFAULT_CONFIG["priority_classes"]
+        return config
+    bad = {name: weight for name, weight in classes.items()
+           if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not 0 < weight < float('inf')}
+    if bad:
+        # A weight of 0 cannot be scheduled and a negative one would starve every other class
+        logging.error(f"Priority class weights must be positive numbers, using 1 for {bad}")
+        config["priority_classes"] = {**classes, **dict.fromkeys(bad, 1)}
+    return config
 
 
 class SystemConfig:
+    """
+    System configuration backed by system_config.json.
+
+    self.config is an immutable snapshot that is replaced as a whole, never
+    modified, so readers get a consistent view without locking or file I/O;
+    nested dicts and lists in it are read-only too. The file only holds the
+    settings that differ from DEFAULT_CONFIG, which stays in memory. Saves
+    write a temporary file and rename it over the config file, and a
+    background thread reloads the file when another process changed it.
+    """
+
     def __init__(self):
-        self.config = {
-            "printer": ""
-        }
+        self.config = _freeze(DEFAULT_CONFIG)
         self.config_file = "system_config.json"
+        # What the file holds, and in-memory values kept on top of it, see override
+        self.file_config = {}
+        self.overrides = {}
+        self.file_state = None
+        self.write_lock = threading.Lock()
         self.load_config()
+        self.watcher = threading.Thread(target=self._watch, name="config-watcher", daemon=True)
+        self.watcher.start()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.config_file)
+        except FileNotFoundError:
+            return None
+        # The inode changes on every atomic save, the mtime catches edits in place
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _publish(self, config_data):
+        self.file_config = config_data
+        self.config = _freeze(_validate({**DEFAULT_CONFIG, **config_data, **self.overrides}))
 
     def load_config(self):
         """Load system configuration from file."""
         try:
             if os.path.exists(self.config_file):
+                self.file_state = self._stat()
                 with open(self.config_file, 'r') as f:
-                    self.config = json.load(f)
+                    self._publish(_read_object(f))
                 logging.info("System configuration loaded successfully")
             else:
+                # Not created here, so later changes to the defaults still apply
                 logging.warning("System configuration file not found, using default configuration")
-                # Create default config file
-                self.save_config(self.config)
+                self._publish({})
         except Exception as e:
             logging.error(f"Error loading system configuration: {str(e)}")
-            self.config = {"printer": ""}
+            self._publish({})
 
     def save_config(self, config_data):
-        """Save system configuration to file."""
-        try:
-            with open(self.config_file, 'w') as f:
-                json.dump(config_data, f)
-            self.config = config_data
-            logging.info("System configuration saved successfully")
-            return True
-        except Exception as e:
-            logging.error(f"Error saving system configuration: {str(e)}")
-            return False
+        """Save system configuration to file, keeping keys not in config_data."""
+        with self.write_lock:
+            config_data = {**self.file_config, **config_data}
+            directory = os.path.dirname(os.path.abspath(self.config_file))
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".system_config.", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(config_data, f)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    # Readers of the file see either the old or the new config
+                    os.replace(tmp_path, self.config_file)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+                self.file_state = self._stat()
+                self._publish(config_data)
+                logging.info("System configuration saved successfully")
+                return True
+            except Exception as e:
+                logging.error(f"Error saving system configuration: {str(e)}")
+                return False
+
+    def override(self, values):
+        """Keep values on top of the file in this process only, e.g. for the benchmark."""
+        with self.write_lock:
+            self.overrides.update(values)
+            self._publish(self.file_config)
+
+    def _watch(self):
+        while True:
+            time.sleep(CONFIG_POLL_INTERVAL)
+            state = self._stat()
+            if state is None or state == self.file_state:
+                continue
+            with self.write_lock:
+                try:
+                    with open(self.config_file, 'r') as f:
+                        self._publish(_read_object(f))
+                except Exception as e:
+                    # Half-written by an editor that does not save atomically, or not a
+                    # configuration at all: keep the current one and look again
+                    logging.warning(f"Could not reload system configuration: {str(e)}")
+                    continue
+                finally:
+                    # Only read again once it changes
+                    self.file_state = state
+            logging.info("System configuration reloaded after a change on disk")
 
     def get_printer(self):
         """Get the default printer name."""
         return self.config.get("printer", "")
 
+    def get(self, key):
+        """Get a single configuration value, falling back to the default."""
+        return self.config.get(key, DEFAULT_CONFIG.get(key))
+
     def get_config(self):
         """Get the entire configuration dictionary."""
-        return self.config.copy()  # Return a copy to prevent external modification
+        return dict(self.config)  # Return a copy to prevent external modification
 
 # Create global instances
 system_config = SystemConfig()
@@ -57,4 +239,15 @@ def save_system_config(config_data):
     return system_config.save_config(config_data)
 
 def get_default_printer():
-    return system_config.get_printer() 
\ No newline at end of file
+    return system_config.get_printer()
+
+def get_printer_pool():
+    return system_config.get("printers") or [system_config.get_printer()]
+
+def get_pipeline_config():
+    return {
+        "download_workers": system_config.get("download_workers"),
+        "print_workers": system_config.get("print_workers"),
+        "queue_size": system_config.get("queue_size"),
+        "max_inflight_jobs": system_config.get("max_inflight_jobs"),
+    }
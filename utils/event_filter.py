@@ -0,0 +1,22 @@
+from utils.config import system_config
+
+
+def skip_reason(record):
+    """
+    Why an S3 event record should not be downloaded, or None to print it.
+
+    The reason is one of "event_type", "prefix", "suffix" or "size", checked
+    against event_types, event_prefixes, event_suffixes (empty lists allow
+    everything) and the object size in the event against max_object_bytes.
+    """
+    if not (record.event_name or "").startswith(tuple(system_config.get("event_types"))):
+        return "event_type"
+    prefixes = system_config.get("event_prefixes")
+    if prefixes and not record.key.startswith(tuple(prefixes)):
+        return "prefix"
+    suffixes = system_config.get("event_suffixes")
+    if suffixes and not record.key.lower().endswith(tuple(suffix.lower() for suffix in suffixes)):
+        return "suffix"
+    if record.size is not None and record.size > system_config.get("max_object_bytes"):
+        return "size"
+    return None
@@ -0,0 +1,105 @@
+import threading
+import time
+
+from utils.logger import logger
+from utils.metrics import SQS_VISIBILITY_CHANGES
+
+# SQS accepts at most 10 entries per batch call
+BATCH_SIZE = 10
+
+
+class _Lease:
+    def __init__(self, message, visible_until):
+        self.message = message
+        self.visible_until = visible_until
+
+
+class VisibilityHeartbeat:
+    """
+    Keep in-flight SQS messages invisible while their labels are handled.
+
+    Every tracked message is extended by visibility_timeout seconds with
+    change_visibility(queue_url, entries), a change_message_visibility_batch call,
+    shortly before its current timeout runs out, so a short queue visibility
+    timeout does not lead to a second delivery of a label that is still
+    printing. release(message) makes a message visible again right away for
+    a fast retry, forget(message) stops tracking one that was deleted.
+    """
+
+    def __init__(self, change_visibility, visibility_timeout=30):
+        self.change_visibility = change_visibility
+        self.visibility_timeout = visibility_timeout
+        # Extend when less than a third of the timeout is left
+        self.margin = visibility_timeout / 3
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def track(self, message):
+        """Start extending a message that was just received."""
+        lease = _Lease(message, time.monotonic() + self.visibility_timeout)
+        with self.lock:
+            self.leases[message.receipt_handle] = lease
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="sqs-heartbeat", daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def forget(self, message):
+        """Stop extending a message, e.g. once it is deleted."""
+        with self.lock:
+            self.leases.pop(message.receipt_handle, None)
+
+    def release(self, message):
+        """Hand a message back to SQS to be delivered again immediately."""
+        self.forget(message)
+        self._change([message], 0, "released")
+
+    def pending(self):
+        """Number of messages being kept invisible."""
+        with self.lock:
+            return len(self.leases)
+
+    def _run(self):
+        while True:
+            # Sleep until there is something to extend
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending():
+                now = time.monotonic()
+                with self.lock:
+                    due = [lease for lease in self.leases.values() if lease.visible_until - now <= self.margin]
+                for lease in due:
+                    lease.visible_until = now + self.visibility_timeout
+                for i in range(0, len(due), BATCH_SIZE):
+                    self._change([lease.message for lease in due[i:i + BATCH_SIZE]],
+                                 self.visibility_timeout, "extended")
+                time.sleep(min(1, self.margin / 2))
+
+    def _change(self, messages, timeout, result):
+        queues = {}
+        for message in messages:
+            queues.setdefault(message.queue_url, []).append(message)
+        for queue_url, batch in queues.items():
+            self._change_batch(queue_url, batch, timeout, result)
+
+    def _change_batch(self, queue_url, messages, timeout, result):
+        try:
+            response = self.change_visibility(queue_url, [
+                {'Id': str(i), 'ReceiptHandle': message.receipt_handle, 'VisibilityTimeout': timeout}
+                for i, message in enumerate(messages)
+            ])
+        except Exception as e:
+            SQS_VISIBILITY_CHANGES.labels("error").inc(len(messages))
+            logger.error(f"Change message visibility failed: {e}")
+            return
+        failed = response.get('Failed', [])
+        SQS_VISIBILITY_CHANGES.labels(result).inc(len(messages) - len(failed))
+        SQS_VISIBILITY_CHANGES.labels("error").inc(len(failed))
+        for entry in failed:
+            message = messages[int(entry['Id'])]
+            # The receipt handle is no longer valid, SQS may deliver the message again
+            logger.warning(f"Change visibility of message {message.message_id} failed: "
+                           f"{entry.get('Code')} {entry.get('Message')}")
+            self.forget(message)
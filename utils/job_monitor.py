@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import cups
+from utils.config import system_config
+from utils.metrics import CUPS_JOB_SECONDS, CUPS_JOBS
+
+# IPP job-state values
+JOB_PROCESSING = 5
+JOB_STOPPED = 6
+JOB_CANCELED = 7
+JOB_ABORTED = 8
+JOB_COMPLETED = 9
+
+
+class JobFuture(Future):
+    """
+    Future of (success, error) for a CUPS job, None job_id if submission
+    failed. A label waiting in a batch only gets its job_id once the batch
+    is submitted, add_submitted_callback(fn) calls fn(job_id) at that point.
+    """
+
+    def __init__(self, job_id=None, printer_name=None):
+        super().__init__()
+        self.job_id = job_id
+        self.printer_name = printer_name
+        self._submitted_callbacks = []
+        self._submitted_lock = threading.Lock()
+
+    def set_job_id(self, job_id):
+        with self._submitted_lock:
+            self.job_id = job_id
+            callbacks, self._submitted_callbacks = self._submitted_callbacks, []
+        for fn in callbacks:
+            fn(job_id)
+
+    def add_submitted_callback(self, fn):
+        """Call fn(job_id) once the label is in a CUPS job, right away if it already is."""
+        with self._submitted_lock:
+            if self.job_id is None:
+                self._submitted_callbacks.append(fn)
+                return
+        fn(self.job_id)
+
+
+class _Watch:
+    def __init__(self, job_id, printer_name, timeout):
+        self.job_id = job_id
+        self.submitted = time.monotonic()
+        self.timeout = timeout
+        # Set once the printer starts on the job, time spent queued does not count
+        self.deadline = None
+        self.future = JobFuture(job_id, printer_name)
+
+
+class JobMonitor:
+    """
+    Track every outstanding CUPS job from a single thread.
+
+    Instead of each submitter polling getJobAttributes once a second, the
+    monitor sweeps all watched jobs with one getJobs call per interval and
+    resolves a Future with (success, error) for each job that finishes. Jobs
+    still not finished timeout seconds (cups_job_timeout if None) after the
+    printer started on them are cancelled; jobs queued behind others on the
+    printer are left alone however long they wait.
+    """
+
+    def __init__(self, interval=0.2, timeout=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def watch(self, job_id, callback=None, timeout=None, printer_name=None):
+        """Start tracking job_id, returning a JobFuture of (success, error)."""
+        watch = _Watch(job_id, printer_name, timeout or self.timeout or system_config.get("cups_job_timeout"))
+        if callback is not None:
+            watch.future.add_done_callback(lambda future: callback(*future.result()))
+        with self.lock:
+            self.jobs[job_id] = watch
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="cups-job-monitor", daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return watch.future
+
+    def pending(self):
+        """Number of jobs submitted but not finished yet."""
+        with self.lock:
+            return len(self.jobs)
+
+    def _run(self):
+        conn = None
+        while True:
+            # Sleep until there is something to watch
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending():
+                try:
+                    if conn is None:
+                        conn = cups.Connection()
+                    self._sweep(conn)
+                except (cups.IPPError, RuntimeError) as e:
+                    logging.error(f"Error checking job status: {str(e)}")
+                    # Reconnect on the next sweep
+                    conn = None
+                time.sleep(self.interval)
+
+    def _sweep(self, conn):
+        with self.lock:
+            watches = dict(self.jobs)
+        # Only the jobs still queued or printing, not the whole history
+        states = conn.getJobs(which_jobs='not-completed', requested_attributes=['job-id', 'job-state'])
+        now = time.monotonic()
+        for job_id, watch in watches.items():
+            if job_id in states:
+                job_state = states[job_id].get('job-state')
+            else:
+                # Finished since the last sweep, ask for its final state
+                try:
+                    job_state = conn.getJobAttributes(job_id, requested_attributes=['job-state'])['job-state']
+                except cups.IPPError as e:
+                    if e.args[0] != cups.IPP_NOT_FOUND:
+                        raise
+                    # Purged from the job history before we saw it finish
+                    logging.error(f"Print job {job_id} is unknown to CUPS")
+                    self._resolve(watch, "unknown", False, Exception(f"Print job {job_id} is unknown to CUPS"))
+                    continue
+            if job_state in (JOB_PROCESSING, JOB_STOPPED) and watch.deadline is None:
+                watch.deadline = now + watch.timeout
+            if job_state == JOB_COMPLETED:
+                logging.info(f"Print job {job_id} completed successfully!")
+                self._resolve(watch, "completed", True, None)
+            elif job_state in (JOB_CANCELED, JOB_ABORTED):
+                logging.error(f"Print job {job_id} failed with state: {job_state}")
+                result = "canceled" if job_state == JOB_CANCELED else "aborted"
+                self._resolve(watch, result, False, Exception(f"Print job failed with state: {job_state}"))
+            elif watch.deadline is not None and now > watch.deadline:
+                try:
+                    # Cancel the print job
+                    conn.cancelJob(job_id)
+                    logging.error(f"Print job {job_id} timed out and was cancelled")
+                    self._resolve(watch, "timeout", False, Exception("Timeout and cancel job"))
+                except cups.IPPError as e:
+                    self._resolve(watch, "cancel_failed", False, e)
+
+    def _resolve(self, watch, result, success, error):
+        with self.lock:
+            self.jobs.pop(watch.job_id, None)
+        CUPS_JOBS.labels(result).inc()
+        CUPS_JOB_SECONDS.labels(result).observe(time.monotonic() - watch.submitted)
+        watch.future.set_result((success, error))
+
+
+# Create global instance
+job_monitor = JobMonitor()
@@ -0,0 +1,309 @@
+import contextlib
+import sqlite3
+import threading
+import time
+
+from utils.config import system_config
+
+# Job states, in the order a label goes through them. Labels are laid out
+# in memory and streamed to CUPS in one step, so there is no separate
+# durable "rendered" state between downloaded and submitted.
+RECEIVED = "received"
+DOWNLOADED = "downloaded"
+SUBMITTED = "submitted"
+PRINTED = "printed"
+FAILED = "failed"
+# Out of retries, kept for an operator to look at and replay
+DEAD_LETTER = "dead_letter"
+# Replay requested from the console, waiting for a worker to claim it
+REPLAY = "replay"
+
+UNFINISHED = (RECEIVED, DOWNLOADED, SUBMITTED)
+# Returned by receive for a label another live worker process is handling, never stored
+IN_PROGRESS = "in_progress"
+
+# A worker that has not reported for this long no longer owns its labels
+OWNER_LOST_AFTER = 30
+FINISHED = (PRINTED, FAILED, DEAD_LETTER)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_key TEXT PRIMARY KEY,
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    message_id TEXT,
+    receipt_handle TEXT,
+    queue_url TEXT,
+    state TEXT NOT NULL,
+    cups_job_id INTEGER,
+    error TEXT,
+    owner TEXT,
+    owner_pid INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    labels INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    seen_at REAL NOT NULL
+);
+"""
+
+
+def job_key(bucket, key, etag):
+    """Identity of a label: the same object version is only printed once."""
+    return f"{bucket}/{key}@{etag}"
+
+
+class JobJournal:
+    """
+    Durable record of every label, in a SQLite database in WAL mode.
+
+    Each S3 object version (bucket, key, ETag) has one row that follows it
+    from received to printed or dead-lettered, together with the SQS message
+    it came in. Redelivered messages for labels that already printed are
+    found with a primary key lookup and skipped, and labels that were in
+    flight when the process stopped are picked up again on the next start.
+    Dead-lettered labels stay until they are replayed.
+
+    With several worker processes, set_owner names the one using this
+    journal. Every unfinished label belongs to the worker that last took it,
+    and other workers leave it alone while its owner keeps reporting through
+    worker_seen; labels of a worker not seen for OWNER_LOST_AFTER seconds are
+    taken over.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.owner = None
+        self.owner_pid = None
+        if readonly:
+            # For the console, which only looks at what the workers recorded
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            return
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Durable across process crashes, fsync only at checkpoints
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        # Columns missing from journals written by earlier versions
+        for column, definition in (("queue_url", "TEXT"), ("owner", "TEXT"), ("owner_pid", "INTEGER")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+
+    def set_owner(self, name, pid):
+        """Take the labels received from now on for the worker process name with pid."""
+        self.owner, self.owner_pid = name, pid
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Holds the write lock from the first read, so no other process can change what was read
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _owned_elsewhere(self, owner, owner_pid, now):
+        """Whether another worker process that is still alive owns a label."""
+        if owner is None or (owner, owner_pid) == (self.owner, self.owner_pid):
+            return False
+        row = self.conn.execute(
+            "SELECT 1 FROM workers WHERE name = ? AND pid = ? AND state != 'stopped' AND seen_at > ?",
+            (owner, owner_pid, now - OWNER_LOST_AFTER)).fetchone()
+        return row is not None
+
+    def receive(self, bucket, key, etag, message_id, receipt_handle, queue_url=None):
+        """
+        Record that a label arrived and take it for this worker, returning
+        the state it had before (None if it is new) and its CUPS job id.
+        IN_PROGRESS means another live worker is handling it and nothing was
+        changed. Other labels that are not printed yet are reset to received
+        with the new message, except those already sent to CUPS: they keep
+        their state and only take over the new message.
+        """
+        now = time.time()
+        with self._transaction():
+            row = self.conn.execute("SELECT state, cups_job_id, owner, owner_pid FROM jobs WHERE job_key = ?",
+                                    (job_key(bucket, key, etag),)).fetchone()
+            previous, cups_job_id, owner, owner_pid = row if row else (None, None, None, None)
+            if previous == PRINTED:
+                return previous, cups_job_id
+            if previous in UNFINISHED and self._owned_elsewhere(owner, owner_pid, now):
+                return IN_PROGRESS, None
+            if previous == SUBMITTED and cups_job_id is not None:
+                # At the printer already, resetting it would print the label twice
+                self.conn.execute(
+                    """
+                    UPDATE jobs SET message_id = ?, receipt_handle = ?, queue_url = ?, owner = ?, owner_pid = ?,
+                                    attempts = attempts + 1, updated_at = ?
+                    WHERE job_key = ?
+                    """,
+                    (message_id, receipt_handle, queue_url, self.owner, self.owner_pid, now,
+                     job_key(bucket, key, etag)))
+                return previous, cups_job_id
+            self.conn.execute(
+                """
+                INSERT INTO jobs (job_key, bucket, key, etag, message_id, receipt_handle, queue_url, state,
+                                  owner, owner_pid, attempts, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT (job_key) DO UPDATE SET
+                    message_id = excluded.message_id,
+                    receipt_handle = excluded.receipt_handle,
+                    queue_url = excluded.queue_url,
+                    state = excluded.state,
+                    owner = excluded.owner,
+                    owner_pid = excluded.owner_pid,
+                    cups_job_id = NULL,
+                    error = NULL,
+                    attempts = attempts + 1,
+                    updated_at = excluded.updated_at
+                """,
+                (job_key(bucket, key, etag), bucket, key, etag, message_id, receipt_handle, queue_url,
+                 RECEIVED, self.owner, self.owner_pid, now, now))
+            return previous, None
+
+    def update(self, bucket, key, etag, state, cups_job_id=None, error=None):
+        """Move an unfinished label to state, a finished label is left alone."""
+        with self.lock:
+            self.conn.execute(
+                """
+                UPDATE jobs SET state = ?, cups_job_id = COALESCE(?, cups_job_id), error = ?, updated_at = ?
+                WHERE job_key = ? AND state NOT IN (?, ?, ?)
+                """,
+                (state, cups_job_id, str(error) if error else None, time.time(),
+                 job_key(bucket, key, etag), *FINISHED))
+
+    def retry(self, bucket, key, etag, error):
+        """Count another attempt of an unfinished label and record why the last one failed."""
+        with self.lock:
+            self.conn.execute(
+                """
+                UPDATE jobs SET state = ?, cups_job_id = NULL, error = ?, attempts = attempts + 1, updated_at = ?
+                WHERE job_key = ? AND state NOT IN (?, ?, ?)
+                """,
+                (RECEIVED, str(error) if error else None, time.time(), job_key(bucket, key, etag), *FINISHED))
+
+    def unfinished(self, before=None):
+        """
+        Rows of the labels that were neither printed nor failed, oldest
+        first, only those last updated before the given time if set. Labels
+        another live worker owns are left out, the others are taken for this
+        worker.
+        """
+        now = time.time()
+        with self._transaction():
+            cursor = self.conn.execute(
+                f"""
+                SELECT job_key, bucket, key, etag, message_id, receipt_handle, queue_url, state, cups_job_id,
+                       owner, owner_pid FROM jobs
+                WHERE state IN ({', '.join('?' * len(UNFINISHED))}) AND updated_at < ? ORDER BY created_at
+                """, (*UNFINISHED, now if before is None else before))
+            rows = [row for row in self._rows(cursor)
+                    if not self._owned_elsewhere(row['owner'], row['owner_pid'], now)]
+            self.conn.executemany("UPDATE jobs SET owner = ?, owner_pid = ? WHERE job_key = ?",
+                                  [(self.owner, self.owner_pid, row['job_key']) for row in rows])
+            return rows
+
+    def dead_letters(self):
+        """Rows of the dead-lettered labels, most recent first."""
+        with self.lock:
+            cursor = self.conn.execute(
+                """
+                SELECT job_key, bucket, key, etag, queue_url, error, attempts, updated_at FROM jobs
+                WHERE state = ? ORDER BY updated_at DESC
+                """, (DEAD_LETTER,))
+            return self._rows(cursor)
+
+    def replay(self, job_keys):
+        """Ask the workers to print dead-lettered labels again, returning how many were found."""
+        with self.lock:
+            cursor = self.conn.execute(
+                f"""
+                UPDATE jobs SET state = ?, updated_at = ?
+                WHERE state = ? AND job_key IN ({', '.join('?' * len(job_keys))})
+                """, (REPLAY, time.time(), DEAD_LETTER, *job_keys))
+            return cursor.rowcount
+
+    def claim_replays(self):
+        """
+        Rows of the labels waiting to be replayed, moved back to received so
+        that only one worker process picks each of them up. Their SQS message
+        was deleted when they were dead-lettered, so they have none.
+        """
+        with self._transaction():
+            cursor = self.conn.execute("SELECT bucket, key, etag FROM jobs WHERE state = ?", (REPLAY,))
+            rows = self._rows(cursor)
+            self.conn.execute(
+                """
+                UPDATE jobs SET state = ?, message_id = NULL, receipt_handle = NULL, queue_url = NULL,
+                                cups_job_id = NULL, error = NULL, owner = ?, owner_pid = ?, attempts = 1,
+                                updated_at = ?
+                WHERE state = ?
+                """, (RECEIVED, self.owner, self.owner_pid, time.time(), REPLAY))
+        return rows
+
+    def counts(self):
+        """Number of labels in each state."""
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def worker_seen(self, name, pid, state, labels):
+        """Record that a worker process is alive, its state and the labels it is handling."""
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT INTO workers (name, pid, state, labels, started_at, seen_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    -- A restarted worker reuses the name of the one it replaces
+                    started_at = CASE WHEN pid = excluded.pid THEN started_at ELSE excluded.started_at END,
+                    pid = excluded.pid,
+                    state = excluded.state, labels = excluded.labels, seen_at = excluded.seen_at
+                """,
+                (name, pid, state, labels, now, now))
+
+    def workers(self):
+        """Rows of the worker processes, most recently seen first."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "SELECT name, pid, state, labels, started_at, seen_at FROM workers ORDER BY seen_at DESC")
+            return self._rows(cursor)
+
+    @staticmethod
+    def _rows(cursor):
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def prune(self, retention_days):
+        """Forget printed and failed labels older than retention_days, dead letters are kept."""
+        cutoff = time.time() - retention_days * 86400
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?",
+                              (PRINTED, FAILED, cutoff))
+            self.conn.execute("DELETE FROM workers WHERE seen_at < ?", (cutoff,))
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """The process-wide journal, opened and pruned on first use."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = JobJournal(system_config.get("journal_path"))
+            _journal.prune(system_config.get("journal_retention_days"))
+        return _journal
@@ -0,0 +1,122 @@
+import codecs
+import unicodedata
+
+# Characters that must not start a line (closing punctuation)
+NO_LINE_START = set("，。、；：？！）》」』】〕〉”’…—・·%,.;:?!)]}>")
+# Characters that must not end a line (opening punctuation)
+NO_LINE_END = set("（《「『【〔〈“‘([{<")
+
+INDENT = " " * 10
+
+# A longer line without a newline is split, so a streamed text never has to
+# be held in memory as a whole
+MAX_LINE_CHARS = 64 * 1024
+
+
+def _char_width(char):
+    if unicodedata.combining(char):
+        return 0
+    if unicodedata.east_asian_width(char) in ('W', 'F'):
+        return 2
+    return 1
+
+
+# Display width of every BMP code point, looked up instead of recomputed
+_WIDTH_TABLE = bytes(_char_width(chr(cp)) for cp in range(0x10000))
+
+
+def char_width(char):
+    """Display width of a character: 2 for CJK full-width, 0 for combining marks."""
+    cp = ord(char)
+    if cp < 0x10000:
+        return _WIDTH_TABLE[cp]
+    return _char_width(char)
+
+
+def text_width(text):
+    return sum(char_width(char) for char in text)
+
+
+def wrap_text(text, width):
+    """
+    Wrap text to lines of at most width display columns.
+
+    Closing punctuation never starts a line: it hangs past the margin on the
+    previous line instead. Opening punctuation never ends a line: it moves to
+    the next one. Each character is measured once, so this is linear in the
+    length of the text.
+    """
+    lines = []
+    for paragraph in text.splitlines():
+        n = len(paragraph)
+        start = i = 0
+        line_width = 0
+        while i < n:
+            w = char_width(paragraph[i])
+            if line_width + w <= width or i == start:
+                line_width += w
+                i += 1
+                continue
+            end = i
+            if paragraph[end] in NO_LINE_START:
+                while end < n and paragraph[end] in NO_LINE_START:
+                    end += 1
+            elif end - 1 > start and paragraph[end - 1] in NO_LINE_END:
+                end -= 1
+            lines.append(paragraph[start:end])
+            start = i = end
+            line_width = 0
+        if start < n:
+            lines.append(paragraph[start:])
+    return lines
+
+
+def paginate(lines, max_lines):
+    """Split lines into label-sized pages."""
+    return [lines[i:i + max_lines] for i in range(0, len(lines), max_lines)]
+
+
+def pad(line, width):
+    """Left-align line and pad it with spaces to width display columns."""
+    return line + " " * max(width - text_width(line), 0)
+
+
+def _layout_page(page, max_width):
+    aligned = [pad(INDENT + line, len(INDENT) + max_width) for line in page]
+    return '\n'.join(aligned) + '\n\n' + '-' * max_width + '\n\n'  # Label separator
+
+
+def layout_label(text, max_width=50, max_lines=20):
+    """Lay out text as a sequence of labels separated by dashed lines."""
+    return ''.join(layout_pages(text.splitlines(), max_width, max_lines))
+
+
+def layout_pages(lines, max_width=50, max_lines=20):
+    """Lay out an iterable of lines one label at a time, see layout_label."""
+    page = []
+    for line in lines:
+        for wrapped in wrap_text(line, max_width):
+            page.append(wrapped)
+            if len(page) == max_lines:
+                yield _layout_page(page, max_width)
+                page = []
+    if page:
+        yield _layout_page(page, max_width)
+
+
+def iter_lines(chunks, encoding='utf-8'):
+    """Decode an iterable of byte chunks into lines, holding at most one line."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    buffer = ''
+    for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        lines = buffer.splitlines(keepends=True)
+        buffer = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        for line in lines:
+            yield line.rstrip('\r\n')
+        while len(buffer) > MAX_LINE_CHARS:
+            yield buffer[:MAX_LINE_CHARS]
+            buffer = buffer[MAX_LINE_CHARS:]
+    buffer += decoder.decode(b'', final=True)
+    if buffer:
+        yield from buffer.splitlines()
@@ -0,0 +1,203 @@
+import bisect
+import functools
+import glob
+import gzip
+import os
+import re
+import threading
+from collections import deque
+from datetime import datetime
+
+# Matches the asctime prefix written by utils.logger
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+TIMESTAMP_LENGTH = 19
+# JSON lines written by utils.logger start with the timestamp
+JSON_PREFIX = '{"time": "'
+# One index entry per this many bytes of log
+INDEX_INTERVAL = 64 * 1024
+BLOCK_SIZE = 64 * 1024
+
+
+@functools.lru_cache(maxsize=64)
+def compile_filter(pattern):
+    """Compile a filter regex once, raises re.error if it is invalid."""
+    return re.compile(pattern)
+
+
+def parse_timestamp(line):
+    if line.startswith(JSON_PREFIX):
+        line = line[len(JSON_PREFIX):]
+    try:
+        return datetime.strptime(line[:TIMESTAMP_LENGTH], TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def _open(path):
+    # Rotated logs may be gzip compressed
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class _Index:
+    """Sparse timestamp -> byte offset index of one log file."""
+
+    def __init__(self):
+        self.timestamps = []
+        self.offsets = []
+        self.indexed_upto = 0
+
+    def seek_offset(self, start):
+        """Offset of an indexed line at or before start."""
+        if start is None:
+            return 0
+        i = bisect.bisect_right(self.timestamps, start) - 1
+        return self.offsets[i] if i >= 0 else 0
+
+
+class LogReader:
+    """
+    Incremental reader for a log file and its rotated history.
+
+    tail() keeps the last tail_lines lines and only reads what was appended
+    since the previous call, starting from the end of the file the first
+    time. search() answers time-range queries over the current and rotated
+    files using a sparse timestamp index, so only the matching part of the
+    history is read.
+    """
+
+    def __init__(self, path, tail_lines=200):
+        self.path = path
+        self.lines = deque(maxlen=tail_lines)
+        self.offset = 0
+        self.inode = None
+        self.partial = b''
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def tail(self):
+        """The last tail_lines lines, raises FileNotFoundError without a log."""
+        with self.lock:
+            self._read_new()
+            return list(self.lines)
+
+    def _read_new(self):
+        stat = os.stat(self.path)
+        if stat.st_ino == self.inode and stat.st_size == self.offset:
+            # Nothing was written since the last read
+            return
+        with open(self.path, 'rb') as f:
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                # First read, or the file was rotated or truncated
+                self.inode = stat.st_ino
+                self.lines.clear()
+                self.partial = b''
+                self.offset = self._window_start(f, stat.st_size)
+            if stat.st_size <= self.offset:
+                return
+            f.seek(self.offset)
+            data = self.partial + f.read(stat.st_size - self.offset)
+            self.offset = stat.st_size
+        chunks = data.split(b'\n')
+        # Keep an unterminated last line until the rest of it is written
+        self.partial = chunks.pop()
+        self.lines.extend(chunk.decode('utf-8', errors='replace') + '\n' for chunk in chunks)
+
+    def _window_start(self, f, size):
+        """Offset of the first of the last tail_lines lines, read backwards from the end."""
+        position = size
+        newlines = 0
+        while position > 0:
+            read_size = min(BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size)
+            count = block.count(b'\n')
+            if newlines + count > self.lines.maxlen:
+                # Skip to just after the newline that precedes the window
+                cut = len(block)
+                for _ in range(self.lines.maxlen + 1 - newlines):
+                    cut = block.rindex(b'\n', 0, cut)
+                return position + cut + 1
+            newlines += count
+        return 0
+
+    def history_files(self):
+        """Rotated files, oldest first, followed by the current log."""
+        rotated = sorted(glob.glob(glob.escape(self.path) + '.*'), key=os.path.getmtime)
+        return rotated + [self.path]
+
+    def search(self, pattern=None, start=None, end=None, limit=1000):
+        """
+        Lines between start and end (datetimes, either may be None) matching
+        pattern, oldest first, at most limit of them.
+        """
+        regex = compile_filter(pattern) if pattern else None
+        files = []
+        for path in self.history_files():
+            try:
+                files.append((path, os.stat(path)))
+            except FileNotFoundError:
+                continue
+        with self.lock:
+            # Indexes follow the inode, so they survive the file being rotated
+            live = {stat.st_ino for _, stat in files}
+            self.indexes = {inode: index for inode, index in self.indexes.items() if inode in live}
+        results = []
+        for path, stat in files:
+            if start is not None and datetime.fromtimestamp(stat.st_mtime) < start:
+                # Nothing was written to this file after start
+                continue
+            with self.lock:
+                index = self._index(path, stat)
+            if end is not None and index.timestamps and index.timestamps[0] > end:
+                break
+            self._scan(path, index.seek_offset(start), regex, start, end, limit, results)
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    def _scan(self, path, offset, regex, start, end, limit, results):
+        timestamp = None
+        with _open(path) as f:
+            f.seek(offset)
+            for raw in f:
+                line = raw.decode('utf-8', errors='replace')
+                # Lines without a timestamp (tracebacks) belong to the previous entry
+                timestamp = parse_timestamp(line) or timestamp
+                if timestamp is not None:
+                    if end is not None and timestamp > end:
+                        return
+                    if start is not None and timestamp < start:
+                        continue
+                if regex is None or regex.search(line):
+                    results.append(line)
+                    if len(results) >= limit:
+                        return
+
+    def _index(self, path, stat):
+        # Offsets into a compressed file are offsets into its decompressed
+        # content, and a compressed file never changes once written
+        compressed = path.endswith('.gz')
+        index = self.indexes.get(stat.st_ino)
+        if index is None or (not compressed and stat.st_size < index.indexed_upto):
+            index = self.indexes[stat.st_ino] = _Index()
+        if index.indexed_upto == 0 or (not compressed and stat.st_size > index.indexed_upto):
+            # Only the part appended since the last query is read
+            with _open(path) as f:
+                f.seek(index.indexed_upto)
+                offset = index.indexed_upto
+                last = index.offsets[-1] if index.offsets else -INDEX_INTERVAL
+                for raw in f:
+                    if not raw.endswith(b'\n'):
+                        break
+                    if offset - last >= INDEX_INTERVAL:
+                        timestamp = parse_timestamp(raw.decode('utf-8', errors='replace'))
+                        if timestamp is not None:
+                            index.timestamps.append(timestamp)
+                            index.offsets.append(offset)
+                            last = offset
+                    offset += len(raw)
+                index.indexed_upto = offset
+        return index
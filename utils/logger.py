@@ -1,36 +1,176 @@
+import atexit
+import contextlib
+import contextvars
+import gzip
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import shutil
+from utils.config import system_config
+
+# Correlation fields attached to every record logged while handling a job
+CONTEXT_FIELDS = ("message_id", "s3_key", "cups_job_id")
+
+# One log file per process role, so that no two processes rotate the same file
+CONSOLE_LOG = "admin.log"
+WORKER_LOG = "worker.log"
+LOG_FILES = (CONSOLE_LOG, WORKER_LOG)
+
+_log_context = contextvars.ContextVar("log_context", default={})
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Attach correlation fields (see CONTEXT_FIELDS) to the records logged inside the block."""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def get_log_context():
+    """Current correlation fields, to carry them over to another thread."""
+    return dict(_log_context.get())
+
+
+class ContextFilter(logging.Filter):
+    """Copy the correlation fields onto the record in the thread that logs it."""
+
+    def filter(self, record):
+        if hasattr(record, "context"):
+            # Already filled in by the worker process that logged it
+            return True
+        context = _log_context.get()
+        for field in CONTEXT_FIELDS:
+            setattr(record, field, context.get(field))
+        record.context = "".join(f" [{field}={context[field]}]" for field in CONTEXT_FIELDS if context.get(field))
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, starting with the timestamp."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def _file_handler(path):
+    """Rotating file handler, by time when log_rotate_when is set, else by size."""
+    if system_config.get("log_rotate_when"):
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path,
+            when=system_config.get("log_rotate_when"),
+            backupCount=system_config.get("log_backup_count"),
+            encoding="utf-8",
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path,
+            maxBytes=system_config.get("log_max_bytes"),
+            backupCount=system_config.get("log_backup_count"),
+            encoding="utf-8",
+        )
+    if system_config.get("log_compress"):
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
+
 
 def setup_logger(name, log_file, level=logging.INFO):
-    """Set up logger with file handler"""
-    
+    """
+    Set up logger with a rotating file handler.
+
+    Records are put on a queue and formatted and written by a QueueListener
+    thread, so the threads that log never wait on the disk.
+    """
+
     # Create logs directory if it doesn't exist
     os.makedirs("logs", exist_ok=True)
-    # if not os.path.exists('logs'):
-    #     os.makedirs('logs')
-    
+
     # Create logger
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    
+    if logger.handlers:
+        # Already set up by an earlier import
+        return logger
+
     # Create file handler
-    file_handler = logging.FileHandler(f'logs/{log_file}')
+    file_handler = _file_handler(f'logs/{log_file}')
     file_handler.setLevel(level)
-    
-    # Create console handler
-    # console_handler = logging.StreamHandler()
-    # console_handler.setLevel(level)
-    
+
     # Create formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if system_config.get("log_format") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s%(context)s')
     file_handler.setFormatter(formatter)
-    # console_handler.setFormatter(formatter)
-    
+
+    # Hand records to a background thread
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    # Flush what is still queued on exit
+    atexit.register(listener.stop)
+
     # Add handlers to logger
-    logger.addHandler(file_handler)
-    # logger.addHandler(console_handler)
-    
+    logger.addHandler(queue_handler)
+    # Do not also write synchronously through handlers of the root logger
+    logger.propagate = False
+
     return logger
 
-# Create loggers for admin
-logger = setup_logger('admin', 'admin.log')
\ No newline at end of file
+
+def forward_logs(log_queue, level=logging.INFO):
+    """
+    Send the records of this process to log_queue, a multiprocessing queue
+    drained by receive_logs in the parent, which is the only process that
+    writes the worker log.
+    """
+    logger.setLevel(level)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    logger.addHandler(handler)
+    logger.propagate = False
+
+
+def receive_logs(log_queue):
+    """
+    Write the records forwarded by worker processes through the handlers
+    setup_logger gave this process, returning the started listener.
+    """
+    listener = logging.handlers.QueueListener(log_queue, *logger.handlers)
+    listener.start()
+    return listener
+
+
+# The logger every module writes to. Where its records go is set up by the
+# entry point of each process, with setup_logger or forward_logs, not here
+logger = logging.getLogger('admin')
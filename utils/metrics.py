@@ -0,0 +1,85 @@
+import threading
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from utils.config import system_config
+
+# Label printing takes seconds, the default buckets stop at 10 s
+PRINT_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120)
+
+SQS_RECEIVES = Counter(
+    "voyager_sqs_receives_total", "receive_message calls", ["queue", "result"])
+SQS_MESSAGES = Counter(
+    "voyager_sqs_messages_total", "Messages received from SQS", ["queue"])
+SQS_RECEIVE_SECONDS = Histogram(
+    "voyager_sqs_receive_seconds", "Duration of receive_message calls, including the long poll", ["queue"])
+RECEIVE_BATCH_SIZE = Gauge(
+    "voyager_sqs_receive_batch_size", "Messages asked for in the last receive, 0 while polling is paused",
+    ["queue"])
+SQS_VISIBILITY_CHANGES = Counter(
+    "voyager_sqs_visibility_changes_total", "Messages extended or released by the visibility heartbeat",
+    ["result"])
+
+S3_EVENTS_SKIPPED = Counter(
+    "voyager_s3_events_skipped_total", "S3 event records filtered out before download", ["reason"])
+S3_DOWNLOADS = Counter(
+    "voyager_s3_downloads_total", "S3 object downloads", ["result"])
+S3_DOWNLOAD_BYTES = Counter(
+    "voyager_s3_download_bytes_total", "Bytes downloaded from S3")
+S3_DOWNLOAD_SECONDS = Histogram(
+    "voyager_s3_download_seconds", "Duration of S3 object downloads")
+
+LAYOUT_SECONDS = Histogram(
+    "voyager_label_layout_seconds", "Time to lay out or render one label", ["mode"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "voyager_pipeline_queue_wait_seconds", "Time a label waited for a pipeline stage", ["stage"],
+    buckets=PRINT_BUCKETS)
+QUEUE_DEPTH = Gauge(
+    "voyager_pipeline_queue_depth", "Labels waiting for a pipeline stage", ["stage"])
+LABEL_SECONDS = Histogram(
+    "voyager_label_seconds", "Time from receiving a label to knowing its print outcome", ["priority"],
+    buckets=PRINT_BUCKETS)
+LABEL_RETRIES = Counter(
+    "voyager_label_retries_total", "Failed labels scheduled for another attempt")
+DEAD_LETTERS = Counter(
+    "voyager_dead_letters_total", "Labels dead-lettered after their last attempt failed")
+
+CUPS_JOBS = Counter(
+    "voyager_cups_jobs_total", "Finished CUPS jobs by outcome", ["result"])
+CUPS_JOB_SECONDS = Histogram(
+    "voyager_cups_job_seconds", "Time from submitting a CUPS job to its completion", ["result"],
+    buckets=PRINT_BUCKETS)
+
+PRINTER_STATE = Gauge(
+    "voyager_printer_state", "IPP printer-state (3 idle, 4 processing, 5 stopped)", ["printer"])
+PRINTER_QUEUED_JOBS = Gauge(
+    "voyager_printer_queued_jobs", "Jobs queued on the printer", ["printer"])
+PRINTER_STATUS = Gauge(
+    "voyager_printer_status", "1 for the current status of the printer", ["printer", "status"])
+
+_server_lock = threading.Lock()
+_server_started = False
+
+
+def start_metrics_server(offset=0):
+    """
+    Expose /metrics on metrics_port once per process, 0 disables it.
+    Worker processes each listen on metrics_port + offset.
+    """
+    global _server_started
+    port = system_config.get("metrics_port")
+    with _server_lock:
+        if _server_started or not port:
+            return
+        start_http_server(port + offset, addr=system_config.get("metrics_addr"))
+        _server_started = True
+
+
+def record_printers(snapshot, describe):
+    """Update the printer gauges from a printer registry snapshot."""
+    PRINTER_STATUS.clear()
+    for name, info in snapshot.items():
+        PRINTER_STATE.labels(name).set(info.get('printer-state') or 0)
+        PRINTER_QUEUED_JOBS.labels(name).set(info.get('queued-jobs', 0))
+        PRINTER_STATUS.labels(name, describe(info).strip()).set(1)
@@ -0,0 +1,579 @@
+import json
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from utils.journal import DEAD_LETTER, DOWNLOADED, FAILED, IN_PROGRESS, PRINTED, SUBMITTED, job_key
+from utils.logger import log_context, logger
+from utils.retry import PermanentError, RetryScheduler, backoff
+from utils.scheduler import FairQueue
+from utils.metrics import (DEAD_LETTERS, LABEL_RETRIES, LABEL_SECONDS, QUEUE_DEPTH, QUEUE_WAIT_SECONDS,
+                           RECEIVE_BATCH_SIZE, S3_EVENTS_SKIPPED)
+
+# Sentinel pushed through the stage queues to shut workers down
+_STOP = object()
+
+# SQS accepts at most 10 entries per batch call
+ACK_BATCH_SIZE = 10
+# and returns at most 10 messages per receive
+RECEIVE_BATCH_MAX = 10
+# Longest pause between capacity checks while polling is paused
+BACKPRESSURE_WAIT = 1
+# How long the ack stage waits for more messages before flushing a batch
+ACK_BATCH_WINDOW = 0.2
+# How often the journal is checked for dead letters to replay
+REPLAY_INTERVAL = 5
+# Pause before a due retry tries the download stage again while it is full
+RETRY_FULL_WAIT = 0.5
+
+
+class Message:
+    """
+    An SQS message and the number of labels still waiting on it. The receive
+    function tags raw messages with the 'QueueUrl' they came from and, for
+    queues whose labels all share a priority class, its 'Priority'. Labels
+    replayed from the dead letters have a message without a receipt handle.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.message_id = raw.get('MessageId')
+        self.receipt_handle = raw['ReceiptHandle']
+        self.queue_url = raw.get('QueueUrl')
+        self.priority = raw.get('Priority')
+        # The Shard it was received by, None for messages resumed from the journal
+        self.shard = None
+        self.pending = 0
+        self.failed = 0
+        # A label of this message is still handled under an earlier delivery
+        self.deferred = False
+        self.lock = threading.Lock()
+
+
+class LabelJob:
+    """A single S3 object to download and print."""
+
+    def __init__(self, message, bucket, key, etag=''):
+        self.message = message
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.priority = None
+        # Set when the label is already with CUPS under an earlier delivery
+        self.cups_job_id = None
+        self.document = None
+        self.success = False
+        self.error = None
+        self.attempts = 1
+        self.received_at = time.monotonic()
+        self.enqueued_at = self.received_at
+
+
+# One object of an S3 event notification, size is None if the event has none
+S3Record = namedtuple('S3Record', ['bucket', 'key', 'etag', 'event_name', 'size'])
+
+
+def parse_records(body):
+    """Return the S3Records in a message body, ValueError if it is not an S3 event."""
+    body = json.loads(body)
+    if not isinstance(body, dict):
+        raise ValueError(f"expected a JSON object, got {type(body).__name__}")
+    records = []
+    # If it's an S3 event, handle it
+    for record in body.get('Records', []):
+        if record.get('eventSource') == 'aws:s3':
+            obj = record['s3']['object']
+            records.append(S3Record(record['s3']['bucket']['name'], obj['key'], obj.get('eTag', ''),
+                                    record.get('eventName'), obj.get('size')))
+    return records
+
+
+class Shard:
+    """
+    One SQS queue feeding the pipeline: receive(max_messages) returns a list
+    of its raw messages, pollers is the number of threads long polling it and
+    max_inflight, if set, caps the labels from this queue in the pipeline so
+    that one busy queue cannot take all the room.
+    """
+
+    def __init__(self, name, receive, pollers=1, max_inflight=None):
+        self.name = name
+        self.receive = receive
+        self.pollers = pollers
+        self.max_inflight = max_inflight
+        # Labels in the pipeline and messages being received, under the pipeline's lock
+        self.labels = 0
+        self.reserved = 0
+
+
+class Pipeline:
+    """
+    Receive -> download -> print pipeline joined by bounded queues.
+
+    The shards' pollers feed shared download and print stages, and a message
+    is acked only once every label in it has printed. The pollers ask for no
+    more messages than there is room for in their Shard and, if capacity() is
+    given, in the printers plus lookahead, so backlog waits in SQS. The stages
+    serve the classes named by classify(key, metadata) through a FairQueue.
+
+    A failed label is retried up to max_attempts times through a
+    RetryScheduler. With a heartbeat, its messages stay invisible while they
+    are handled and are handed back as soon as a label fails. With a journal,
+    progress is recorded, printed labels are skipped on redelivery, labels
+    last updated before resume_before are resumed on start and labels that
+    fail for good are dead-lettered; without one, their messages are left in
+    SQS to be delivered again.
+    """
+
+    def __init__(self, shards, download, submit, ack, journal=None, watch=None, heartbeat=None,
+                 resume_before=None, capacity=None, classify=None, lookahead=0, skip=None,
+                 max_attempts=1, retry_base_delay=2, retry_max_delay=300,
+                 download_workers=4, print_workers=2, queue_size=20, max_inflight_jobs=20):
+        self.shards = shards
+        self.download = download
+        self.submit = submit
+        self.ack = ack
+        self.journal = journal
+        self.watch = watch
+        self.heartbeat = heartbeat
+        self.resume_before = resume_before
+        self.capacity = capacity
+        self.classify = classify
+        self.lookahead = lookahead
+        self.skip = skip
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.retries = RetryScheduler(self._retry_due)
+        # Labels handled by this process right now, by job_key
+        self.active = set()
+        self.active_lock = threading.Lock()
+        # Labels sent to CUPS whose job has not finished yet
+        self.submitted = 0
+        # Messages asked for by receives in progress
+        self.reserved = 0
+        self.room_changed = threading.Condition(self.active_lock)
+        self.download_workers = download_workers
+        self.print_workers = print_workers
+        self.max_inflight_jobs = max_inflight_jobs
+        self.inflight = threading.BoundedSemaphore(max_inflight_jobs)
+        self.download_queue = FairQueue(maxsize=queue_size)
+        self.print_queue = FairQueue(maxsize=queue_size)
+        self.ack_queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.receivers = []
+        self.downloaders = []
+        self.printers = []
+        self.ackers = []
+
+    def start(self):
+        if self.resume_before is None:
+            self.resume_before = time.time()
+        QUEUE_DEPTH.labels("download").set_function(self.download_queue.qsize)
+        QUEUE_DEPTH.labels("print").set_function(self.print_queue.qsize)
+        QUEUE_DEPTH.labels("ack").set_function(self.ack_queue.qsize)
+        QUEUE_DEPTH.labels("retry").set_function(self.retries.pending)
+        if self.journal is not None:
+            self._spawn(self._resume, "journal-resume")
+            self._spawn(self._replay_loop, "journal-replay")
+        self.receivers = [self._spawn(lambda shard=shard: self._receive_loop(shard), f"sqs-{shard.name}-{i}")
+                          for shard in self.shards for i in range(shard.pollers)]
+        self.downloaders = [self._spawn(self._download_loop, f"s3-download-{i}")
+                            for i in range(self.download_workers)]
+        self.printers = [self._spawn(self._print_loop, f"print-dispatch-{i}")
+                         for i in range(self.print_workers)]
+        self.ackers = [self._spawn(self._ack_loop, "sqs-ack")]
+        logger.info(f"Pipeline started with {len(self.receivers)} pollers on {len(self.shards)} queues, "
+                    f"{self.download_workers} download workers and {self.print_workers} print workers")
+
+    def run(self):
+        """Start the pipeline and block until it is stopped."""
+        self.start()
+        for thread in self.receivers + self.downloaders + self.printers + self.ackers:
+            thread.join()
+
+    def labels(self):
+        """Number of labels this pipeline is handling."""
+        with self.active_lock:
+            return len(self.active)
+
+    def stop(self, timeout=None):
+        """
+        Stop receiving and drain the jobs already in the pipeline, returning
+        whether they all finished. After timeout seconds the labels still in
+        progress, e.g. queued on an offline printer, are left unfinished in the
+        journal and SQS for the next start.
+        """
+        self.stop_event.set()
+        with self.room_changed:
+            self.room_changed.notify_all()
+        drain = self._spawn(self._drain, "pipeline-drain")
+        drain.join(timeout)
+        if drain.is_alive():
+            logger.warning(f"Stopped draining after {timeout}s, leaving {self.labels()} labels unfinished")
+            return False
+        logger.info("Pipeline stopped")
+        return True
+
+    def _drain(self):
+        for thread in self.receivers:
+            thread.join()
+        for _ in self.downloaders:
+            self.download_queue.put(_STOP)
+        for thread in self.downloaders:
+            thread.join()
+        for _ in self.printers:
+            self.print_queue.put(_STOP)
+        for thread in self.printers:
+            thread.join()
+        # Wait for the jobs already sent to CUPS to finish
+        for _ in range(self.max_inflight_jobs):
+            self.inflight.acquire()
+        self.ack_queue.put(_STOP)
+        for thread in self.ackers:
+            thread.join()
+
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def _receive_loop(self, shard):
+        logger.info(f"Polling SQS queue {shard.name} for messages...")
+        while not self.stop_event.is_set():
+            batch = self._reserve(shard)
+            if batch == 0:
+                continue
+            try:
+                messages = shard.receive(batch)
+                for raw in messages:
+                    try:
+                        self._accept(raw, shard)
+                    except Exception as e:
+                        # Left in SQS, the rest of the batch is still handled
+                        logger.error(f"Handling message {raw.get('MessageId')} failed: {e}")
+            except Exception as e:
+                logger.error(f"Receive from {shard.name} failed: {e}")
+                self.stop_event.wait(1)
+            finally:
+                with self.room_changed:
+                    self.reserved -= batch
+                    shard.reserved -= batch
+
+    def _reserve(self, shard):
+        """
+        Wait until there is room for messages from shard and reserve it,
+        returning the batch size, or 0 once the pipeline stops.
+        """
+        paused = False
+        while not self.stop_event.is_set():
+            # Asked outside the lock, the printer registry may be loading
+            capacity = self.capacity() if self.capacity is not None else None
+            with self.room_changed:
+                batch = self._room(shard, capacity)
+                RECEIVE_BATCH_SIZE.labels(shard.name).set(batch)
+                if batch:
+                    self.reserved += batch
+                    shard.reserved += batch
+                    if paused:
+                        logger.debug(f"Resuming polling of {shard.name}")
+                    return batch
+                if not paused:
+                    logger.debug(f"Printers are saturated or offline, pausing polling of {shard.name}")
+                    paused = True
+                # Until a label finishes or the printers may have changed
+                self.room_changed.wait(BACKPRESSURE_WAIT)
+        return 0
+
+    def _room(self, shard, capacity):
+        """How many messages to ask shard for, 0 while downstream is saturated."""
+        labels = len(self.active) + self.reserved
+        room = self.max_inflight_jobs + self.download_queue.maxsize + self.print_queue.maxsize - labels
+        if capacity is not None:
+            # Labels still on their way to the printers take part of it,
+            # nothing is pulled for printers that are all offline
+            room = min(room, capacity + self.lookahead - (labels - self.submitted)) if capacity else 0
+        if shard.max_inflight is not None:
+            room = min(room, shard.max_inflight - shard.labels - shard.reserved)
+        return max(0, min(RECEIVE_BATCH_MAX, room))
+
+    def _accept(self, raw, shard=None):
+        message = Message(raw)
+        message.shard = shard
+        try:
+            records = parse_records(raw['Body'])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # Acked below like a message without records, it would fail the same way every time
+            logger.error(f"Malformed message {message.message_id}: {e!r}")
+            records = []
+        jobs = []
+        for record in records:
+            with log_context(message_id=message.message_id, s3_key=record.key):
+                reason = self.skip(record) if self.skip is not None else None
+                if reason is not None:
+                    # Filtered before anything is downloaded
+                    S3_EVENTS_SKIPPED.labels(reason).inc()
+                    logger.info(f"Skipping {record.event_name} of {record.key} ({record.size} bytes): {reason}")
+                    continue
+                logger.info(f"New file detected: {record.key}")
+                job = self._admit(message, record.bucket, record.key, record.etag)
+            if job is not None:
+                jobs.append(job)
+        if not jobs:
+            if not message.deferred:
+                self.ack_queue.put(message)
+            return
+        message.pending = len(jobs)
+        if self.heartbeat is not None:
+            self.heartbeat.track(message)
+        for job in jobs:
+            if job.cups_job_id is not None and self.watch is not None:
+                self._watch_submitted(job)
+            else:
+                # Blocks while the download stage is saturated
+                self.download_queue.put(job)
+
+    def _admit(self, message, bucket, key, etag):
+        """The job for a label, or None if it must not be handled again now."""
+        with self.active_lock:
+            if job_key(bucket, key, etag) in self.active:
+                # Redelivered while still in progress here. This delivery is not deleted,
+                # its next one is skipped and deleted once the label printed
+                logger.info(f"{key} is already in progress, leaving the new delivery in SQS")
+                message.deferred = True
+                return None
+            previous = cups_job_id = None
+            if self.journal is not None:
+                previous, cups_job_id = self.journal.receive(bucket, key, etag, message.message_id,
+                                                             message.receipt_handle, message.queue_url)
+                if previous == PRINTED:
+                    logger.info(f"Skipping duplicate of already printed {key}")
+                    return None
+                if previous == IN_PROGRESS:
+                    # Same as above, for a label another worker process is handling
+                    logger.info(f"{key} is in progress in another worker, leaving the new delivery in SQS")
+                    message.deferred = True
+                    return None
+            self.active.add(job_key(bucket, key, etag))
+            if message.shard is not None:
+                message.shard.labels += 1
+        job = self._job(message, bucket, key, etag)
+        if previous == SUBMITTED:
+            logger.info(f"{key} is already CUPS job {cups_job_id}, waiting for it instead of printing it again")
+            job.cups_job_id = cups_job_id
+        return job
+
+    def _job(self, message, bucket, key, etag):
+        job = LabelJob(message, bucket, key, etag)
+        if message.priority is not None:
+            job.priority = message.priority
+        elif self.classify is not None:
+            job.priority = self.classify(key, None)
+        else:
+            job.priority = "default"
+        return job
+
+    def _resume(self):
+        """Put the labels left unfinished by a previous run back in the pipeline."""
+        rows = self.journal.unfinished(before=self.resume_before)
+        if rows:
+            logger.info(f"Resuming {len(rows)} unfinished labels from the journal")
+        messages = {}
+        for row in rows:
+            message = messages.get(row['message_id'])
+            if message is None:
+                message = messages[row['message_id']] = Message(
+                    {'MessageId': row['message_id'], 'ReceiptHandle': row['receipt_handle'],
+                     'QueueUrl': row['queue_url']})
+            message.pending += 1
+        if self.heartbeat is not None:
+            # Handles that expired while we were down are dropped on the first extension
+            for message in messages.values():
+                if message.receipt_handle is not None:
+                    self.heartbeat.track(message)
+        for row in rows:
+            job = self._job(messages[row['message_id']], row['bucket'], row['key'], row['etag'])
+            with self.active_lock:
+                self.active.add(job_key(job.bucket, job.key, job.etag))
+            if row['state'] == SUBMITTED and row['cups_job_id'] and self.watch is not None:
+                job.cups_job_id = row['cups_job_id']
+                self._watch_submitted(job)
+            else:
+                self.download_queue.put(job)
+
+    def _watch_submitted(self, job):
+        """Wait for the CUPS job a label is already in instead of printing it again."""
+        self.inflight.acquire()
+        with self.active_lock:
+            self.submitted += 1
+        self.watch(job.cups_job_id, self._print_callback(job))
+
+    def _replay_loop(self):
+        """Put the dead letters an operator asked to replay back in the pipeline."""
+        while not self.stop_event.wait(REPLAY_INTERVAL):
+            try:
+                rows = self.journal.claim_replays()
+            except Exception as e:
+                logger.error(f"Claiming dead letters to replay failed: {e}")
+                continue
+            for row in rows:
+                # Its message was deleted when it was dead-lettered
+                message = Message({'MessageId': None, 'ReceiptHandle': None})
+                message.pending = 1
+                job = self._job(message, row['bucket'], row['key'], row['etag'])
+                with self.active_lock:
+                    self.active.add(job_key(job.bucket, job.key, job.etag))
+                with log_context(s3_key=job.key):
+                    logger.info(f"Replaying dead letter {job.key}")
+                self.download_queue.put(job)
+
+    def _download_loop(self):
+        while True:
+            job = self.download_queue.get()
+            if job is _STOP:
+                return
+            QUEUE_WAIT_SECONDS.labels("download").observe(time.monotonic() - job.enqueued_at)
+            with log_context(message_id=job.message.message_id, s3_key=job.key):
+                try:
+                    job.document, metadata = self.download(job.bucket, job.key)
+                except Exception as e:
+                    logger.error(f"Download failed: {e}")
+                    job.error = e
+                    self._complete(job)
+                    continue
+            if self.classify is not None and metadata and job.message.priority is None:
+                job.priority = self.classify(job.key, metadata)
+            self._record(job, DOWNLOADED)
+            job.enqueued_at = time.monotonic()
+            self.print_queue.put(job)
+
+    def _print_loop(self):
+        while True:
+            job = self.print_queue.get()
+            if job is _STOP:
+                return
+            QUEUE_WAIT_SECONDS.labels("print").observe(time.monotonic() - job.enqueued_at)
+            # Blocks while too many jobs are waiting on the printers
+            self.inflight.acquire()
+            with self.active_lock:
+                self.submitted += 1
+            with log_context(message_id=job.message.message_id, s3_key=job.key):
+                try:
+                    future = self.submit(job.key, job.document, self._print_callback(job))
+                except Exception as e:
+                    self._print_callback(job)(False, e)
+                    continue
+            # Batched labels only get their CUPS job id once the batch is submitted.
+            # Recording it does nothing if the job already finished
+            future.add_submitted_callback(lambda job_id, job=job: self._record(job, SUBMITTED, cups_job_id=job_id))
+
+    def _print_callback(self, job):
+        def done(success, error):
+            job.success, job.error = success, error
+            # Release the label text as soon as the job is finished
+            job.document = None
+            self.inflight.release()
+            with self.active_lock:
+                self.submitted -= 1
+            self._complete(job)
+        return done
+
+    def _record(self, job, state, cups_job_id=None, error=None):
+        if self.journal is None:
+            return
+        try:
+            self.journal.update(job.bucket, job.key, job.etag, state, cups_job_id, error)
+        except Exception as e:
+            logger.error(f"Journal update failed: {e}")
+
+    def _retry(self, job):
+        delay = backoff(job.attempts, self.retry_base_delay, self.retry_max_delay)
+        LABEL_RETRIES.inc()
+        logger.warning(f"Attempt {job.attempts} of {self.max_attempts} for {job.key} failed, "
+                       f"retrying in {delay:.1f}s: {job.error}")
+        job.attempts += 1
+        job.document = None
+        job.cups_job_id = None
+        if self.journal is not None:
+            try:
+                self.journal.retry(job.bucket, job.key, job.etag, job.error)
+            except Exception as e:
+                logger.error(f"Journal update failed: {e}")
+        self.retries.schedule(delay, job)
+
+    def _retry_due(self, job):
+        if self.stop_event.is_set():
+            # Left unfinished in the journal and in SQS for the next start
+            return
+        job.error = None
+        job.enqueued_at = time.monotonic()
+        try:
+            # Never wait on the scheduler's thread, the other due retries would wait with it
+            self.download_queue.put(job, block=False)
+        except queue.Full:
+            self.retries.schedule(RETRY_FULL_WAIT, job)
+
+    def _complete(self, job):
+        if not job.success and job.attempts < self.max_attempts and not isinstance(job.error, PermanentError):
+            self._retry(job)
+            return
+        LABEL_SECONDS.labels(job.priority).observe(time.monotonic() - job.received_at)
+        if job.success:
+            self._record(job, PRINTED)
+        elif self.journal is not None:
+            # Kept in the journal to be replayed, its message is deleted as if it printed
+            DEAD_LETTERS.inc()
+            logger.error(f"Giving up on {job.key} after {job.attempts} attempts, dead-lettered: {job.error}")
+            self._record(job, DEAD_LETTER, error=job.error)
+        else:
+            self._record(job, FAILED, error=job.error)
+        with self.room_changed:
+            self.active.discard(job_key(job.bucket, job.key, job.etag))
+            if job.message.shard is not None:
+                job.message.shard.labels -= 1
+            self.room_changed.notify_all()
+        message = job.message
+        with message.lock:
+            message.pending -= 1
+            if not job.success and self.journal is None:
+                message.failed += 1
+            done = message.pending == 0
+        if not done:
+            return
+        if message.failed:
+            # Not deleted, SQS delivers it again
+            logger.warning(f"Message {message.message_id} has {message.failed} failed labels, "
+                           f"leaving it in SQS to be retried")
+            if self.heartbeat is not None:
+                self.heartbeat.release(message)
+        elif message.deferred:
+            if self.heartbeat is not None:
+                self.heartbeat.forget(message)
+        elif message.receipt_handle is not None:
+            self.ack_queue.put(message)
+
+    def _ack_loop(self):
+        stopping = False
+        while not stopping:
+            message = self.ack_queue.get()
+            if message is _STOP:
+                return
+            batch = [message]
+            # Collect whatever else completes shortly after to share one call
+            while len(batch) < ACK_BATCH_SIZE:
+                try:
+                    message = self.ack_queue.get(timeout=ACK_BATCH_WINDOW)
+                except queue.Empty:
+                    break
+                if message is _STOP:
+                    stopping = True
+                    break
+                batch.append(message)
+            try:
+                self.ack(batch)
+            except Exception as e:
+                logger.error(f"Acknowledge failed: {e}")
+            if self.heartbeat is not None:
+                for message in batch:
+                    self.heartbeat.forget(message)
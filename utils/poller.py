@@ -0,0 +1,219 @@
+import functools
+import tempfile
+import time
+from utils.printer_pool import printer_pool
+from utils.logger import get_log_context, log_context, logger
+from utils.config import get_pipeline_config, system_config
+from utils.pipeline import Pipeline, Shard
+from utils.journal import get_journal
+from utils.job_monitor import job_monitor
+from utils.heartbeat import VisibilityHeartbeat
+from utils.layout import iter_lines
+from utils.retry import PermanentError
+from utils.scheduler import classify
+from utils.event_filter import skip_reason
+from utils.aws import get_client
+from utils.metrics import (S3_DOWNLOAD_BYTES, S3_DOWNLOAD_SECONDS, S3_DOWNLOADS, SQS_MESSAGES,
+                           SQS_RECEIVE_SECONDS, SQS_RECEIVES)
+
+q_url = 'https://sqs.eu-north-1.amazonaws.com/613860947073/testq'
+region_name = 'eu-north-1'
+# Read size of spooled objects
+STREAM_CHUNK_BYTES = 64 * 1024
+
+def s3():
+    return get_client('s3')
+
+def sqs(region=None):
+    return get_client('sqs', region_name=region or region_name)
+
+
+def get_queues():
+    """
+    The SQS queues to poll from sqs_queues, by default the queue above plus
+    the optional priority queue.
+    """
+    queues = system_config.get("sqs_queues")
+    if queues:
+        return [{"name": queue.get("name") or queue["url"].rsplit('/', 1)[-1], **queue} for queue in queues]
+    queues = [{"name": "default", "url": q_url}]
+    if system_config.get("sqs_priority_queue_url"):
+        queues.append({"name": "priority", "url": system_config.get("sqs_priority_queue_url"),
+                       "priority": system_config.get("sqs_priority_class")})
+    return queues
+
+
+def _region(queue_url):
+    for queue in get_queues():
+        if queue["url"] == queue_url:
+            return queue.get("region")
+    return None
+
+def download_new_file(bucket, key):
+    text = download_label(bucket, key)[0]
+    return text if isinstance(text, str) else '\n'.join(text)
+
+
+def download_label(bucket, key):
+    """
+    Text of a label and the metadata of its S3 object. Text objects larger
+    than stream_threshold_bytes are spooled to a temporary file and returned
+    as an iterator of lines that reads the file chunk by chunk while the
+    label is printed, so neither the object nor an S3 connection is held
+    while the label waits for a printer.
+    """
+    start = time.monotonic()
+    try:
+        response = s3().get_object(Bucket=bucket, Key=key)
+        size = response.get('ContentLength', 0)
+        if size > system_config.get("max_object_bytes"):
+            response['Body'].close()
+            raise PermanentError(f"{key} is {size} bytes, over max_object_bytes")
+        metadata = response.get('Metadata', {})
+        if size > system_config.get("stream_threshold_bytes") and system_config.get("render_mode") != "pdf":
+            spool = _spool(response['Body'])
+            S3_DOWNLOAD_SECONDS.observe(time.monotonic() - start)
+            S3_DOWNLOADS.labels("spooled").inc()
+            logger.info(f"Spooled {key} ({size} bytes)")
+            return iter_lines(_read_chunks(spool)), metadata
+        # Read small objects into memory, nothing is written to disk
+        data = response['Body'].read()
+    except Exception:
+        S3_DOWNLOADS.labels("error").inc()
+        raise
+    S3_DOWNLOAD_SECONDS.observe(time.monotonic() - start)
+    S3_DOWNLOADS.labels("ok").inc()
+    S3_DOWNLOAD_BYTES.inc(len(data))
+    logger.info(f"Downloaded {key}")
+    return data.decode('utf-8', errors='replace'), metadata
+
+
+def _spool(body):
+    """Copy an S3 body to an anonymous temporary file, removed once it is closed."""
+    spool = tempfile.TemporaryFile()
+    try:
+        for chunk in _read_chunks(body):
+            S3_DOWNLOAD_BYTES.inc(len(chunk))
+            spool.write(chunk)
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool
+
+
+def _read_chunks(f):
+    try:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_BYTES), b''):
+            yield chunk
+    finally:
+        f.close()
+
+
+def print_new_file(key, text, callback=None):
+    # Print file on the least-loaded printer of the pool
+    logger.info(f"start print file {key}")
+    future = printer_pool.submit(text, f"Job for {key}")
+    # The job finishes on the job monitor thread, carry the correlation ids over
+    context = get_log_context()
+
+    def done(future):
+        success, error = future.result()
+        with log_context(**context, cups_job_id=future.job_id):
+            if success:
+                logger.info(f"Print {key} successfully!")
+            else:
+                logger.error(f"Print {key} failed with error {error}")
+        if callback is not None:
+            callback(success, error)
+
+    future.add_done_callback(done)
+    return future
+
+
+def handle_new_file(bucket, key):
+    logger.info(f"New file detected: {key}")
+    try:
+        text = download_new_file(bucket, key)
+    except Exception as e:
+        logger.error(f"Download failed: {e}")
+        return False, e
+    return print_new_file(key, text).result()
+
+
+def receive_from(queue, max_messages=10):
+    """Long poll one queue from get_queues."""
+    try:
+        with SQS_RECEIVE_SECONDS.labels(queue["name"]).time():
+            response = sqs(queue.get("region")).receive_message(
+                QueueUrl=queue["url"],
+                MaxNumberOfMessages=max_messages,
+                WaitTimeSeconds=10,
+                VisibilityTimeout=system_config.get("sqs_visibility_timeout")
+            )
+    except Exception:
+        SQS_RECEIVES.labels(queue["name"], "error").inc()
+        raise
+    messages = response.get('Messages', [])
+    SQS_RECEIVES.labels(queue["name"], "messages" if messages else "empty").inc()
+    SQS_MESSAGES.labels(queue["name"]).inc(len(messages))
+    for message in messages:
+        # Needed to delete the message and to schedule its labels
+        message['QueueUrl'] = queue["url"]
+        if queue.get("priority"):
+            message['Priority'] = queue["priority"]
+    return messages
+
+
+def receive_messages(max_messages=10):
+    return receive_from(get_queues()[0], max_messages)
+
+
+def _by_queue(messages):
+    queues = {}
+    for message in messages:
+        queues.setdefault(message.queue_url or q_url, []).append(message)
+    return queues.items()
+
+
+def delete_messages(messages):
+    # Delete the messages from the queue once all of their labels have an outcome
+    for queue_url, batch in _by_queue(messages):
+        response = sqs(_region(queue_url)).delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {'Id': str(i), 'ReceiptHandle': message.receipt_handle}
+                for i, message in enumerate(batch)
+            ]
+        )
+        for failed in response.get('Failed', []):
+            logger.error(f"Delete message failed: {failed.get('Code')} {failed.get('Message')}")
+
+
+def change_message_visibility(queue_url, entries):
+    queue_url = queue_url or q_url
+    return sqs(_region(queue_url)).change_message_visibility_batch(QueueUrl=queue_url, Entries=entries)
+
+
+def build_pipeline(**kwargs):
+    shards = [Shard(queue["name"], functools.partial(receive_from, queue),
+                    pollers=queue.get("pollers", 1), max_inflight=queue.get("max_inflight"))
+              for queue in get_queues()]
+    return Pipeline(
+        shards=shards,
+        download=download_label,
+        submit=print_new_file,
+        ack=delete_messages,
+        journal=get_journal(),
+        watch=job_monitor.watch,
+        capacity=printer_pool.capacity,
+        classify=classify,
+        lookahead=system_config.get("scheduler_lookahead"),
+        skip=skip_reason,
+        heartbeat=VisibilityHeartbeat(change_message_visibility, system_config.get("sqs_visibility_timeout")),
+        max_attempts=system_config.get("retry_max_attempts"),
+        retry_base_delay=system_config.get("retry_base_delay"),
+        retry_max_delay=system_config.get("retry_max_delay"),
+        **get_pipeline_config(),
+        **kwargs
+    )
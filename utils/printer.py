@@ -1,8 +1,11 @@
 import logging
-import streamlit as st
 import cups
-import time
 from utils.config import system_config
+from utils.job_monitor import JobFuture, job_monitor
+from utils.layout import layout_label, layout_pages
+from utils.raster import label_renderer
+from utils.metrics import LAYOUT_SECONDS, record_printers
+from utils.printer_registry import printer_registry
 
 print_options = {
     "media": "w100h70",
@@ -19,28 +22,25 @@ print_options = {
 def get_printer_list():
     """Get a list of available printers."""
     try:
-        conn = cups.Connection()
-        printers = conn.getPrinters()
-        return list(printers.keys())
+        return printer_registry.printers()
     except Exception as e:
         logging.error(f"Error getting printer list: {str(e)}")
         return []
 
 def get_printer_status(printer_name):
-    conn = cups.Connection()
-    printers = conn.getPrinters()
-    printer_info = printers[printer_name]
-    logging.info(f"raw printer_info is: {printer_info}")
+    printer_info = printer_registry.get(printer_name)
+    logging.debug(f"raw printer_info is: {printer_info}")
+    return describe_printer(printer_info)
+
+def _record_printer_metrics(snapshot):
+    record_printers(snapshot, describe_printer)
 
+def describe_printer(printer_info):
+    """Map CUPS printer attributes to a human-readable status."""
+    if printer_info is None:
+        return "Unknown"
     # Get printer-state
     state = printer_info.get('printer-state')
-    # Map the state to a human-readable string
-    status_map = {
-        3: "idle",
-        4: "active",
-        5: "offline",
-        6: "error"
-    }.get(state, "Unknown")
 
     # Get printer-state-reasons
     """
@@ -74,178 +74,130 @@ def get_printer_status(printer_name):
         return " Error"
     else:
         return f"Unknown (state={state})" # Ensure it's a list
-    
-    # reasons_message = ", ".join(reasons) if reasons else "No additional information"
-    # return status_map.get(printer_state, 'Unknown')
 
-def print_label(filename, printer_name):
-    targetfile = save_label_text(filename)
+def render_label(text):
+    """
+    Render a label in the configured mode, returning (format, document).
+
+    text is a string, or an iterator of lines for a label streamed from S3,
+    which is laid out page by page as CUPS reads it: the document is then an
+    iterator of bytes instead of bytes.
+    """
+    if not isinstance(text, str):
+        if system_config.get("render_mode") != "pdf":
+            return cups.CUPS_FORMAT_TEXT, (page.encode("utf-8") for page in layout_pages(text))
+        # PDF labels are laid out from the whole text
+        text = "\n".join(text)
+    if system_config.get("render_mode") == "pdf":
+        with LAYOUT_SECONDS.labels("pdf").time():
+            return "application/pdf", label_renderer.render(text, print_options["media"])
+    with LAYOUT_SECONDS.labels("text").time():
+        return cups.CUPS_FORMAT_TEXT, layout_label(text).encode("utf-8")
+
+
+def submit_text(text, printer_name, title, callback=None):
+    """
+    Lay out text in memory and stream it to CUPS without waiting for it to print.
+
+    Returns a JobFuture resolving to (success, error) once the job monitor sees
+    the job finish; callback(success, error) is called at the same time.
+    """
+    return submit_documents([(title, text)], printer_name, title, callback)
+
+
+def submit_documents(documents, printer_name, title, callback=None):
+    """
+    Submit several (name, text) labels as the documents of one CUPS job.
+
+    The filter chain and print options are set up once for the whole job;
+    the JobFuture resolves when the last document has printed.
+    """
+    job_id = None
     try:
-        conn = cups.Connection()
         if printer_name is None:
             printer_name = system_config.get_printer()
         if not printer_name:
             # logging.error("No printer selected")
-            return False, Exception("No printer selected")
-        logging.info(f"Will use printer {printer_name} to print {targetfile}")
-        job_id = conn.printFile(printer_name, targetfile, f"Job for {targetfile}", print_options)
-        logging.info("Print job submitted successfully!")
-        # Wait for job to complete with timeout
-        timeout = 15  # 15 seconds timeout
-        start_time = time.time()
-        while True:
-            # Check for timeout, cancel job after timeout
-            if time.time() - start_time > timeout:
-                try:
-                    # Cancel the print job
-                    conn.cancelJob(job_id)
-                    logging.error("Print job timed out after {timeout} seconds and was cancelled")
-                except cups.IPPError as e:
-                    # logging.error(f"Print job timed out and failed to cancel: {str(e)}")
-                    return False, e
-                return False, Exception("Timeout and cancel job")
-            
-            try:
-                job_info = conn.getJobAttributes(job_id)
-                job_state = job_info.get('job-state')
-                
-                if job_state == 9:  # Completed
-                    logging.info(f"Print job completed successfully!")
-                    return True, None
-                elif job_state in [7, 8]:  # Error or Cancelled
-                    logging.error(f"Print job failed with state: {job_state}")
-                    return False, e
-                    
-                time.sleep(1)  # Check status every second    
-            except cups.IPPError as e:
-                logging.error(f"Error checking job status: {str(e)}")
-                return False, e
+            raise ValueError("No printer selected")
+        rendered = [(name, *render_label(text)) for name, text in documents]
+        conn = cups.Connection()
+        logging.info(f"Will use printer {printer_name} to print {title}")
+        job_id = conn.createJob(printer_name, title, print_options)
+        for i, (name, document_format, document) in enumerate(rendered):
+            last_document = 1 if i == len(rendered) - 1 else 0
+            conn.startDocument(printer_name, job_id, name, document_format, last_document)
+            for data in (document,) if isinstance(document, bytes) else document:
+                conn.writeRequestData(data, len(data))
+            status = conn.finishDocument(printer_name)
+            if status != cups.IPP_OK:
+                raise cups.IPPError(status, f"Sending document failed with status {status}")
+        logging.info(f"Print job {job_id} submitted successfully!")
     except cups.IPPError as e:
         logging.error(f"Printer error: {str(e)}")
-        return False, e
-    except FileNotFoundError as e:
-        logging.error(f"File error: {str(e)}")
-        return False,e
+        _cancel(job_id)
+        return _failed(e, callback)
     except Exception as e:
         logging.error(f"Unexpected error during printing: {str(e)}")
-        return False, e
-    except Exception as e:
-        logging.error(f"Unexpected error during printing: {str(e)}")
-        return False, e
+        _cancel(job_id)
+        return _failed(e, callback)
+    # A job with more documents gets proportionally longer to finish
+    return job_monitor.watch(job_id, callback, timeout=system_config.get("cups_job_timeout") * len(rendered),
+                             printer_name=printer_name)
 
 
-def print_file(filename, printer_name=None):
-    targetfile = save_label_text(filename)
+def submit_label(filename, printer_name, callback=None):
+    """Submit the contents of a text file, see submit_text."""
     try:
-        # Create status container for progress updates
-        status_container = st.empty()
-        status_container.info("Starting print job...")
-        
-        # Step 2: Connect to printer
-        status_container.info("Connecting to printer...")
-        conn = cups.Connection()
-        
-        # Step 3: Submit print job
-        if printer_name is None:
-            printer_name = system_config.get_printer()
-        if not printer_name:
-            status_container.error("No printer selected")
-            return False
-        logging.info(f"Will use printer {printer_name} to print {targetfile}")
-        status_container.info("Submitting print job...")
-        job_id = conn.printFile(printer_name, targetfile, f"Job for {targetfile}", print_options)
-        
-        # Step 4: Monitor job status
-        status_container.info("Print job submitted successfully!")
-        
-        # Wait for job to complete with timeout
-        timeout = 15  # 60 seconds timeout
-        start_time = time.time()
-        
-        while True:
-            # Check for timeout
-            if time.time() - start_time > timeout:
-                try:
-                    # Cancel the print job
-                    conn.cancelJob(job_id)
-                    status_container.error("Print job timed out after 60 seconds and was cancelled")
-                    status_container.error("Please ask admin to check the printer status and try again")
-                    logging.error(f"Print job timed out after 60 seconds and was cancelled")
-                    logging.error(f"Print job timed out after 60 seconds and was cancelled")
-                except cups.IPPError as e:
-                    status_container.error(f"Print job timed out and failed to cancel: {str(e)}")
-                    logging.error(f"Print job timed out and failed to cancel: {str(e)}")
-                    logging.error(f"Print job timed out and failed to cancel: {str(e)}")
-                return False
-                
-            try:
-                job_info = conn.getJobAttributes(job_id)
-                job_state = job_info.get('job-state')
-                
-                if job_state == 9:  # Completed
-                    status_container.success("Print job completed successfully!")
-                    logging.info(f"Print job completed successfully!")
-                    return True
-                elif job_state in [7, 8]:  # Error or Cancelled
-                    status_container.error(f"Print job failed with state: {job_state}")
-                    logging.error(f"Print job failed with state: {job_state}")
-                    return False
-                    
-                time.sleep(1)  # Check status every second
-                
-            except cups.IPPError as e:
-                status_container.error(f"Error checking job status: {str(e)}")
-                logging.error(f"Error checking job status: {str(e)}")
-                return False
-            
-    except cups.IPPError as e:
-        st.error(f"Printer error: {str(e)}")
-        return False
+        with open(filename, 'r') as file:
+            text = file.read()
     except FileNotFoundError as e:
-        st.error(f"File error: {str(e)}")
-        return False
-    except Exception as e:
-        st.error(f"Unexpected error during printing: {str(e)}")
-        return False 
-    except Exception as e:
-        st.error(f"Unexpected error during printing: {str(e)}")
+        logging.error(f"File error: {str(e)}")
+        return _failed(e, callback)
+    return submit_text(text, printer_name, f"Job for {filename}", callback)
+
+
+def _cancel(job_id):
+    # Drop a job whose document never made it to CUPS
+    if job_id is None:
+        return
+    try:
+        cups.Connection().cancelJob(job_id)
+    except (cups.IPPError, RuntimeError) as e:
+        logging.error(f"Failed to cancel job {job_id}: {str(e)}")
+
+
+def _failed(error, callback=None):
+    future = JobFuture()
+    future.set_result((False, error))
+    if callback is not None:
+        callback(False, error)
+    return future
+
+
+def print_label(filename, printer_name):
+    """Print a label and wait for the job to finish, returning (success, error)."""
+    return submit_label(filename, printer_name).result()
+
+
+def print_file(filename, printer_name=None):
+    # Only the admin page uses this, keep Streamlit out of the worker imports
+    import streamlit as st
+
+    # Create status container for progress updates
+    status_container = st.empty()
+    status_container.info("Submitting print job...")
+    if printer_name is None:
+        printer_name = system_config.get_printer()
+    if not printer_name:
+        status_container.error("No printer selected")
         return False
+    success, error = submit_label(filename, printer_name).result()
+    if success:
+        status_container.success("Print job completed successfully!")
+        return True
+    status_container.error(f"Print job failed: {error}")
+    status_container.error("Please ask admin to check the printer status and try again")
+    return False
 
 
-def wrap_chinese(text, width):
-    lines = []
-    for paragraph in text.splitlines():
-        line = ''
-        for char in paragraph:
-            line += char
-            if len(line) >= width:
-                lines.append(line)
-                line = ''
-        if line:
-            lines.append(line)
-    return lines
-
-
-def save_label_text(originfile, max_chars=25, max_lines=20):
-    with open(originfile, 'r') as file:
-        content = file.read()
-    wrapped_lines = []
-    wrapped_lines = wrap_chinese(content, max_chars)
-    # Wrap each paragraph without splitting words
-    # for paragraph in text.split('\n'):
-    #     lines = textwrap.wrap(paragraph, width=max_chars, break_long_words=False, replace_whitespace=False)
-    #     print(lines)
-    #     wrapped_lines.extend(lines)
-
-    # Split into label-sized chunks
-    labels = [wrapped_lines[i:i + max_lines] for i in range(0, len(wrapped_lines), max_lines)]
-    targetfile = originfile.replace(".txt", "-label.txt")
-    with open(targetfile, "w", encoding="utf-8") as f:
-        for label in labels:
-            # Left-align and pad each line to max_chars for uniform width
-            # aligned = [line.ljust(max_chars) for line in label]
-            aligned = [("          " + line).ljust(max_chars + 5) for line in label]
-            f.write('\n'.join(aligned))
-            f.write('\n\n' + '-' * max_chars + '\n\n')  # Label separator
-
-    return targetfile
+printer_registry.add_listener(_record_printer_metrics)
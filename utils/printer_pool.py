@@ -0,0 +1,137 @@
+import logging
+import threading
+
+import cups
+from utils.config import get_printer_pool, system_config
+from utils.batcher import LabelBatcher
+from utils.printer import submit_documents
+from utils.printer_registry import PRINTER_IDLE, PRINTER_PROCESSING, printer_registry
+
+# printer-state-reasons that stop a printer from taking new labels; CUPS may
+# append -error/-warning/-report to them
+BLOCKING_REASONS = (
+    'media-needed', 'media-empty', 'media-jam', 'paused', 'offline',
+    'door-open', 'cover-open', 'toner-empty', 'marker-supply-empty',
+)
+
+
+def is_healthy(printer_info):
+    """Whether a printer from the registry can take new jobs."""
+    if printer_info is None:
+        return False
+    if printer_info.get('printer-state') not in (PRINTER_IDLE, PRINTER_PROCESSING):
+        return False
+    return not any(reason.startswith(BLOCKING_REASONS)
+                   for reason in printer_info.get('printer-state-reasons', []))
+
+
+class PrinterPool:
+    """
+    Spread labels over the configured printers.
+
+    Each label goes to the healthy printer with the fewest queued jobs,
+    counting the jobs this process submitted plus the other jobs the
+    printer registry saw queued at its last refresh. When the registry reports that a printer has
+    faulted, its pending jobs are moved to another healthy printer. With a
+    batch window configured, labels for the same printer are coalesced into
+    multi-document jobs.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.jobs = {}
+        # Jobs queued on each printer by others, as of the last registry refresh
+        self.foreign = {}
+        self.lock = threading.Lock()
+        self.batcher = LabelBatcher(self._submit)
+        registry.add_listener(self._on_refresh)
+
+    def load(self, printer_name):
+        with self.lock:
+            load = len(self.jobs.get(printer_name, ())) + self.foreign.get(printer_name, 0)
+        # A pending batch becomes one more job
+        if self.batcher.pending(printer_name):
+            load += 1
+        return load
+
+    def capacity(self):
+        """
+        How many more jobs the healthy printers can take before each of them
+        has printer_queue_depth jobs queued, 0 when none is healthy.
+        """
+        depth = system_config.get("printer_queue_depth")
+        return sum(max(0, depth - self.load(name)) for name in get_printer_pool()
+                   if name and is_healthy(self.registry.get(name)))
+
+    def choose(self, exclude=(), healthy_only=False):
+        """Least-loaded printer, preferring healthy ones."""
+        printers = [name for name in get_printer_pool() if name and name not in exclude]
+        healthy = [name for name in printers if is_healthy(self.registry.get(name))]
+        if healthy:
+            printers = healthy
+        elif healthy_only:
+            return None
+        if not printers:
+            return None
+        return min(printers, key=self.load)
+
+    def submit(self, text, title, callback=None):
+        """Print text on the least-loaded printer, see submit_text."""
+        printer_name = self.choose()
+        if self.batcher.enabled():
+            future = self.batcher.add(printer_name, text, title)
+        else:
+            future = self._submit([(title, text)], printer_name, title)
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(*f.result()))
+        return future
+
+    def _submit(self, documents, printer_name, title):
+        future = submit_documents(documents, printer_name, title)
+        if future.job_id is not None:
+            with self.lock:
+                self.jobs.setdefault(printer_name, set()).add(future.job_id)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self.lock:
+            for jobs in self.jobs.values():
+                jobs.discard(future.job_id)
+
+    def _on_refresh(self, snapshot):
+        with self.lock:
+            # The snapshot's queue counts include our own jobs, which we track live
+            self.foreign = {name: max(0, info.get('queued-jobs', 0) - len(self.jobs.get(name, ())))
+                            for name, info in snapshot.items()}
+            faulted = [name for name, jobs in self.jobs.items()
+                       if jobs and not is_healthy(snapshot.get(name))]
+        for name in faulted:
+            self.evacuate(name)
+
+    def evacuate(self, printer_name):
+        """Move the pending jobs of printer_name to other healthy printers."""
+        with self.lock:
+            job_ids = list(self.jobs.get(printer_name, ()))
+        if not job_ids:
+            return
+        conn = cups.Connection()
+        for job_id in job_ids:
+            target = self.choose(exclude=(printer_name,), healthy_only=True)
+            if target is None:
+                logging.warning(f"No healthy printer to take over jobs from {printer_name}")
+                return
+            try:
+                conn.moveJob(job_id=job_id, job_printer_uri=f"ipp://localhost/printers/{target}")
+            except cups.IPPError as e:
+                # Most likely the job finished in the meantime
+                logging.warning(f"Could not move job {job_id} from {printer_name} to {target}: {str(e)}")
+                continue
+            logging.info(f"Moved job {job_id} from faulted printer {printer_name} to {target}")
+            with self.lock:
+                self.jobs[printer_name].discard(job_id)
+                self.jobs.setdefault(target, set()).add(job_id)
+
+
+# Create global instance
+printer_pool = PrinterPool(printer_registry)
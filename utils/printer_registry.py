@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+
+import cups
+from utils.config import system_config
+
+# IPP printer-state values
+PRINTER_IDLE = 3
+PRINTER_PROCESSING = 4
+PRINTER_STOPPED = 5
+
+PRINTER_EVENTS = ['printer-state-changed', 'printer-added', 'printer-deleted']
+# Lease of the event subscription in seconds, renewed at half time, so one left
+# behind by a lost connection expires on its own
+SUBSCRIPTION_LEASE = 300
+# Longest a reader waits for the first refresh of the process
+FIRST_LOAD_WAIT = 1
+
+
+class PrinterRegistry:
+    """
+    In-process snapshot of every CUPS printer.
+
+    A background thread refreshes printer-state, printer-state-reasons and the
+    number of queued jobs per printer every ttl seconds, so readers get the
+    last snapshot from memory instead of asking CUPS. With use_events the
+    thread also refreshes as soon as CUPS reports a printer-state change.
+    Readers never wait for CUPS: while it is unreachable they get the last
+    snapshot, or an empty one if there never was one.
+    """
+
+    def __init__(self, ttl=5, use_events=False):
+        self.ttl = ttl
+        self.use_events = use_events
+        self.snapshot = {}
+        self.updated_at = 0
+        self.lock = threading.Lock()
+        # Set once the first refresh succeeded or failed
+        self.attempted = threading.Event()
+        self.refresh_requested = threading.Event()
+        self.thread = None
+        self.sequence = None
+        self.renew_at = 0
+        self.listeners = []
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="printer-registry", daemon=True)
+                self.thread.start()
+
+    def printers(self):
+        """Names of all known printers."""
+        return list(self._snapshot().keys())
+
+    def get(self, printer_name):
+        """Printer attributes plus 'queued-jobs', or None for an unknown printer."""
+        return self._snapshot().get(printer_name)
+
+    def all(self):
+        return dict(self._snapshot())
+
+    def add_listener(self, callback):
+        """Call callback(snapshot) after every refresh."""
+        self.listeners.append(callback)
+
+    def refresh_soon(self):
+        """Ask the background thread to refresh without waiting for the TTL."""
+        self.refresh_requested.set()
+
+    def refresh(self, conn=None):
+        conn = conn or cups.Connection()
+        printers = conn.getPrinters()
+        queued = dict.fromkeys(printers, 0)
+        jobs = conn.getJobs(which_jobs='not-completed', requested_attributes=['job-id', 'job-printer-uri'])
+        for job in jobs.values():
+            name = job.get('job-printer-uri', '').rsplit('/', 1)[-1]
+            if name in queued:
+                queued[name] += 1
+        snapshot = {}
+        for name, info in printers.items():
+            info = dict(info)
+            reasons = info.get('printer-state-reasons', [])
+            if isinstance(reasons, str):
+                reasons = [reasons]
+            info['printer-state-reasons'] = reasons
+            info['queued-jobs'] = queued[name]
+            snapshot[name] = info
+        # Readers only ever see a complete snapshot
+        self.snapshot = snapshot
+        self.updated_at = time.time()
+        for listener in self.listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logging.error(f"Printer registry listener failed: {str(e)}")
+
+    def _snapshot(self):
+        if not self.attempted.is_set():
+            self.start()
+            self.attempted.wait(FIRST_LOAD_WAIT)
+        return self.snapshot
+
+    def _run(self):
+        conn = None
+        subscription_id = None
+        while True:
+            try:
+                if conn is None:
+                    conn = cups.Connection()
+                    subscription_id = self._subscribe(conn, subscription_id)
+                elif subscription_id is not None and time.monotonic() > self.renew_at:
+                    conn.renewSubscription(subscription_id, lease_duration=SUBSCRIPTION_LEASE)
+                    self.renew_at = time.monotonic() + SUBSCRIPTION_LEASE / 2
+                self.refresh(conn)
+            except (cups.IPPError, RuntimeError) as e:
+                logging.error(f"Error refreshing printers: {str(e)}")
+                conn = None
+            self.attempted.set()
+            self._wait(conn, subscription_id)
+
+    def _subscribe(self, conn, previous=None):
+        if previous is not None:
+            try:
+                conn.cancelSubscription(previous)
+            except cups.IPPError:
+                # Already expired, or gone with a CUPS restart
+                pass
+        if not self.use_events:
+            return None
+        self.sequence = None
+        try:
+            subscription_id = conn.createSubscription('/', events=PRINTER_EVENTS,
+                                                      lease_duration=SUBSCRIPTION_LEASE)
+        except cups.IPPError as e:
+            logging.warning(f"Printer event subscription failed, using TTL refresh only: {str(e)}")
+            return None
+        self.renew_at = time.monotonic() + SUBSCRIPTION_LEASE / 2
+        return subscription_id
+
+    def _wait(self, conn, subscription_id):
+        """Sleep until the TTL expires, a refresh is requested or a printer event arrives."""
+        deadline = time.monotonic() + self.ttl
+        while time.monotonic() < deadline:
+            if conn is None or subscription_id is None:
+                self.refresh_requested.wait(deadline - time.monotonic())
+            elif not self.refresh_requested.wait(1):
+                try:
+                    notifications = conn.getNotifications(
+                        [subscription_id], sequence_numbers=[self.sequence] if self.sequence else None)
+                except cups.IPPError:
+                    continue
+                events = notifications.get('events', [])
+                if events:
+                    self.sequence = events[-1].get('notify-sequence-number', 0) + 1
+                    self.refresh_requested.set()
+            if self.refresh_requested.is_set():
+                self.refresh_requested.clear()
+                return
+
+
+# Create global instance
+printer_registry = PrinterRegistry(
+    ttl=system_config.get("printer_refresh_interval"),
+    use_events=system_config.get("printer_events"),
+)
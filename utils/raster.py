@@ -0,0 +1,132 @@
+import hashlib
+import io
+import math
+import multiprocessing
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from cachetools import LRUCache
+from PIL import Image, ImageDraw, ImageFont
+from utils.config import system_config
+from utils.layout import char_width, paginate, wrap_text
+from utils.retry import PermanentError
+
+POINTS_PER_INCH = 72
+
+# Per-process caches, filled separately in every render process
+_fonts = {}
+_glyphs = {}
+
+
+def media_size(media):
+    """Size in points of a custom CUPS media name such as w100h70."""
+    match = re.fullmatch(r"w(\d+(?:\.\d+)?)h(\d+(?:\.\d+)?)", media)
+    if not match:
+        raise ValueError(f"Unsupported media size: {media}")
+    return float(match.group(1)), float(match.group(2))
+
+
+def _font(font_path, size):
+    key = (font_path, size)
+    if key not in _fonts:
+        try:
+            _fonts[key] = ImageFont.truetype(font_path, size)
+        except OSError as e:
+            # The default font has no CJK glyphs, better a dead letter than an unreadable label
+            raise PermanentError(f"Cannot load render_font {font_path}: {e}") from e
+    return _fonts[key]
+
+
+def _glyph(font_path, size, char, box):
+    """Bitmap mask of a single character, rendered once per font size."""
+    key = (font_path, size, char, box)
+    glyph = _glyphs.get(key)
+    if glyph is None:
+        glyph = Image.new('L', box, 0)
+        ImageDraw.Draw(glyph).text((0, 0), char, font=_font(font_path, size), fill=255)
+        _glyphs[key] = glyph
+    return glyph
+
+
+def render_pdf(text, media, dpi, font_path, max_width, max_lines):
+    """
+    Draw text as a PDF with one page per label.
+
+    Lines are wrapped by the same layout engine as the text mode and every
+    character is placed on a grid of max_width columns and max_lines rows
+    that fills the media, so full-width characters take two cells.
+    """
+    width_pt, height_pt = media_size(media)
+    page_size = (round(width_pt / POINTS_PER_INCH * dpi), round(height_pt / POINTS_PER_INCH * dpi))
+    cell_width = page_size[0] / max_width
+    line_height = page_size[1] / max_lines
+    size = max(int(min(line_height, cell_width * 2) * 0.9), 1)
+
+    pages = []
+    for lines in paginate(wrap_text(text, max_width), max_lines) or [[]]:
+        page = Image.new('L', page_size, 255)
+        for row, line in enumerate(lines):
+            column = 0
+            for char in line:
+                width = char_width(char)
+                if width and not char.isspace():
+                    box = (math.ceil(cell_width * width), math.ceil(line_height))
+                    page.paste(0, (int(column * cell_width), int(row * line_height)),
+                               _glyph(font_path, size, char, box))
+                column += width
+        pages.append(page)
+    out = io.BytesIO()
+    pages[0].save(out, format='PDF', resolution=dpi, save_all=True, append_images=pages[1:])
+    return out.getvalue()
+
+
+class LabelRenderer:
+    """
+    Render labels to PDF in a pool of worker processes.
+
+    Rasterizing is CPU bound, so it runs outside this process and does not
+    hold the GIL the poller and print stages need. Finished PDFs are kept in
+    an LRU cache keyed by a hash of the text and render settings, so repeated
+    or templated labels are not rendered again; a render_cache_size of 0
+    turns the cache off.
+    """
+
+    def __init__(self):
+        size = system_config.get("render_cache_size")
+        self.cache = LRUCache(maxsize=size) if size > 0 else None
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def render(self, text, media, max_width=50, max_lines=20):
+        params = (
+            media,
+            system_config.get("render_dpi"),
+            system_config.get("render_font"),
+            max_width,
+            max_lines,
+        )
+        if self.cache is None:
+            return self._executor().submit(render_pdf, text, *params).result()
+        key = hashlib.sha256(repr(params).encode("utf-8") + text.encode("utf-8")).hexdigest()
+        with self.lock:
+            document = self.cache.get(key)
+        if document is None:
+            document = self._executor().submit(render_pdf, text, *params).result()
+            with self.lock:
+                self.cache[key] = document
+        return document
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                # spawn, as forking a process that runs threads is unsafe
+                self.executor = ProcessPoolExecutor(
+                    max_workers=system_config.get("render_processes"),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self.executor
+
+
+# Create global instance
+label_renderer = LabelRenderer()
@@ -0,0 +1,59 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class PermanentError(Exception):
+    """A failure another attempt would not fix, the label is dead-lettered right away."""
+
+
+def backoff(attempt, base, cap):
+    """
+    Seconds to wait before retry number attempt (1 for the first retry):
+    base doubled on every attempt up to cap, with jitter so that labels that
+    failed together do not all come back at once.
+    """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    # Equal jitter, at least half the delay so the retries still back off
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RetryScheduler:
+    """
+    Delay queue that calls callback(item) once the item's delay has passed.
+
+    Items wait in a heap ordered by due time and a single timer thread hands
+    them back, so nothing sleeps in the pipeline's workers while a label
+    waits for its next attempt.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.heap = []
+        # Tie breaker so items themselves are never compared
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, delay, item):
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), item))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="retry-scheduler", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def pending(self):
+        """Number of items waiting for their retry."""
+        with self.cond:
+            return len(self.heap)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, item = heapq.heappop(self.heap)
+            self.callback(item)
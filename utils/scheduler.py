@@ -0,0 +1,84 @@
+import collections
+import queue
+import threading
+
+from utils.config import system_config
+
+
+def classify(key, metadata=None):
+    """
+    Priority class of a label: the object's "priority" metadata if it names a
+    configured class, else the class of the longest matching key prefix in
+    priority_prefixes, else priority_default.
+    """
+    classes = system_config.get("priority_classes")
+    if metadata and metadata.get("priority") in classes:
+        return metadata["priority"]
+    prefixes = system_config.get("priority_prefixes")
+    matches = [prefix for prefix in prefixes if key.startswith(prefix)]
+    if matches:
+        return prefixes[max(matches, key=len)]
+    return system_config.get("priority_default")
+
+
+class FairQueue:
+    """
+    Bounded queue that shares its output between priority classes by weight.
+
+    put and get work like queue.Queue; an item's class is its priority
+    attribute and class weights come from priority_classes. Stride scheduling
+    picks the class that has received the least service relative to its
+    weight, so with weights 8:1 an interactive label waits behind at most a
+    few bulk labels while bulk labels still get a ninth of the slots when
+    both are queued. A class that was empty rejoins at the current virtual
+    time and cannot save up credit. Items without a priority (the stop
+    sentinel) only come out once every class is empty.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.classes = {}
+        # Virtual finish time of the last item served from each class
+        self.passes = {}
+        self.vtime = 0.0
+        self.last = collections.deque()
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def qsize(self):
+        with self.cond:
+            return self.size
+
+    def put(self, item, block=True):
+        with self.cond:
+            while self.maxsize and self.size >= self.maxsize:
+                if not block:
+                    raise queue.Full
+                self.cond.wait()
+            priority = getattr(item, "priority", None)
+            if priority is None:
+                self.last.append(item)
+            else:
+                items = self.classes.setdefault(priority, collections.deque())
+                if not items:
+                    self.passes[priority] = max(self.passes.get(priority, 0.0), self.vtime)
+                items.append(item)
+            self.size += 1
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while not self.size:
+                self.cond.wait()
+            waiting = [priority for priority, items in self.classes.items() if items]
+            if waiting:
+                weights = system_config.get("priority_classes")
+                priority = min(waiting, key=lambda p: self.passes[p] + 1 / weights.get(p, 1))
+                self.passes[priority] += 1 / weights.get(priority, 1)
+                self.vtime = self.passes[priority]
+                item = self.classes[priority].popleft()
+            else:
+                item = self.last.popleft()
+            self.size -= 1
+            self.cond.notify_all()
+            return item
@@ -0,0 +1,135 @@
+"""
+Headless print worker: polls SQS and prints labels without Streamlit.
+
+    python worker.py
+    python worker.py --processes 4
+
+Each worker process runs its own pipeline; they share the job journal,
+which is also where the admin console reads their status from. SIGTERM or
+Ctrl-C stops receiving and drains the labels already in the pipelines
+before exiting, for at most drain_timeout seconds.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+# Seconds between status updates of a worker in the journal
+STATUS_INTERVAL = 5
+# Extra seconds the supervisor gives a draining worker before killing it
+KILL_GRACE = 10
+# Seconds between prunes of the journal by a running worker
+PRUNE_INTERVAL = 3600
+
+
+def _stop_on_signals(stop):
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+
+def run_worker(index, log_queue, resume_before):
+    """Body of one worker process."""
+    stop = threading.Event()
+    _stop_on_signals(stop)
+
+    from utils.config import system_config
+    from utils.journal import get_journal
+    from utils.logger import WORKER_LOG, forward_logs, logger, setup_logger
+    from utils.metrics import start_metrics_server
+    from utils.poller import build_pipeline
+
+    if log_queue is not None:
+        forward_logs(log_queue)
+    else:
+        setup_logger('admin', WORKER_LOG)
+    start_metrics_server(offset=index)
+    name = f"{socket.gethostname()}-{index}"
+    journal = get_journal()
+
+    def report(state, labels):
+        try:
+            journal.worker_seen(name, os.getpid(), state, labels)
+        except Exception as e:
+            # e.g. the journal is locked by another worker for too long, try again next time
+            logger.error(f"Recording the status of worker {name} failed: {e}")
+
+    # Reported before the first label, so other workers see that its labels are owned
+    journal.set_owner(name, os.getpid())
+    report("starting", 0)
+    pipeline = build_pipeline(resume_before=resume_before)
+    pipeline.start()
+    logger.info(f"Worker {name} started with pid {os.getpid()}")
+    pruned_at = time.monotonic()
+    while not stop.wait(STATUS_INTERVAL):
+        report("running", pipeline.labels())
+        if time.monotonic() - pruned_at > PRUNE_INTERVAL:
+            pruned_at = time.monotonic()
+            try:
+                journal.prune(system_config.get("journal_retention_days"))
+            except Exception as e:
+                logger.error(f"Pruning the journal failed: {e}")
+    logger.info(f"Worker {name} draining {pipeline.labels()} labels")
+    report("draining", pipeline.labels())
+    pipeline.stop(system_config.get("drain_timeout"))
+    report("stopped", 0)
+
+
+def supervise(processes):
+    """Run worker processes, restart the ones that die and stop them all on SIGTERM."""
+    stop = threading.Event()
+    _stop_on_signals(stop)
+
+    from utils.config import system_config
+    from utils.logger import WORKER_LOG, logger, receive_logs, setup_logger
+
+    # The supervisor is the only process writing the worker log
+    setup_logger('admin', WORKER_LOG)
+    ctx = multiprocessing.get_context("spawn")
+    log_queue = ctx.Queue()
+    listener = receive_logs(log_queue)
+    # Only the first worker picks up labels left unfinished before this start
+    started = time.time()
+    workers = {}
+
+    def spawn(index, resume_before):
+        process = ctx.Process(target=run_worker, args=(index, log_queue, resume_before),
+                              name=f"print-worker-{index}")
+        process.start()
+        workers[index] = process
+
+    for index in range(processes):
+        spawn(index, started if index == 0 else 0)
+    while not stop.wait(1):
+        for index, process in list(workers.items()):
+            if not process.is_alive():
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                spawn(index, 0)
+
+    logger.info("Stopping workers")
+    for process in workers.values():
+        process.terminate()
+    deadline = time.monotonic() + system_config.get("drain_timeout") + KILL_GRACE
+    for index, process in workers.items():
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            logger.error(f"Worker {index} did not stop in time, killing it")
+            process.kill()
+            process.join()
+    listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+    if args.processes == 1:
+        run_worker(0, None, None)
+    else:
+        supervise(args.processes)
+
+
+if __name__ == "__main__":
+    main()